@@ -0,0 +1,159 @@
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from motion_planner import MotionPlanner, MotionPlan
+from supply_egg import SupplyEgg
+
+
+class BatchTrip:
+    supply_egg: SupplyEgg
+    target_index: int
+    target: np.ndarray
+    motion_plan: MotionPlan | None
+
+    def __init__(self, supply_egg: SupplyEgg, target_index: int, target: np.ndarray):
+        self.supply_egg = supply_egg
+        self.target_index = target_index
+        self.target = target
+        self.motion_plan = None
+
+    @property
+    def supply_position(self) -> np.ndarray:
+        return np.array((self.supply_egg.grab_x_position_mm, self.supply_egg.grab_y_position_mm))
+
+
+class BatchPlan:
+    trips: list[BatchTrip]
+    motion_plan: MotionPlan
+    travel_mm: float
+    sequential_time_seconds: float
+
+    def __init__(self, trips: list[BatchTrip], motion_plan: MotionPlan, travel_mm: float,
+                 sequential_time_seconds: float):
+        self.trips = trips
+        self.motion_plan = motion_plan
+        self.travel_mm = travel_mm
+        self.sequential_time_seconds = sequential_time_seconds
+
+    @property
+    def batch_time_seconds(self) -> float:
+        return self.motion_plan.estimated_time_seconds + BatchPlanner.INSPECTION_TIME_SECONDS
+
+    @property
+    def eggs_per_minute(self) -> float:
+        return 60 * len(self.trips) / self.batch_time_seconds if self.trips else 0.0
+
+    @property
+    def sequential_eggs_per_minute(self) -> float:
+        return 60 * len(self.trips) / self.sequential_time_seconds if self.trips else 0.0
+
+
+class BatchPlanner:
+    # Time spent re-inspecting the carton after each program
+    INSPECTION_TIME_SECONDS: float = 6.0
+
+    motion_planner: MotionPlanner
+
+    def __init__(self, motion_planner: MotionPlanner):
+        self.motion_planner = motion_planner
+
+    @staticmethod
+    def travel(trips: list[BatchTrip], start_position: np.ndarray) -> float:
+        position = start_position
+        distance = 0.0
+        for trip in trips:
+            distance += np.linalg.norm(trip.supply_position - position) + \
+                np.linalg.norm(trip.target - trip.supply_position)
+            position = trip.target
+        return float(distance)
+
+    def assign(self, targets: np.ndarray, supply_eggs: list[SupplyEgg]) -> list[BatchTrip]:
+        # Pair holes and supply eggs minimising the total supply to hole distance
+        supply_positions = np.array([(e.grab_x_position_mm, e.grab_y_position_mm)
+                                     for e in supply_eggs], dtype=np.float64)
+        cost = np.linalg.norm(
+            supply_positions[:, None, :] - targets[None, :, :], axis=2)
+        supply_indices, target_indices = linear_sum_assignment(cost)
+        return [BatchTrip(supply_eggs[s], int(t), targets[t])
+                for s, t in zip(supply_indices, target_indices)]
+
+    def order(self, trips: list[BatchTrip], start_position: np.ndarray) -> list[BatchTrip]:
+        # Nearest neighbour to start, then 2-opt until no reversal improves
+        remaining = list(trips)
+        ordered = []
+        position = start_position
+        while remaining:
+            trip = min(remaining, key=lambda t: np.linalg.norm(
+                t.supply_position - position))
+            remaining.remove(trip)
+            ordered.append(trip)
+            position = trip.target
+
+        best_travel = BatchPlanner.travel(ordered, start_position)
+        is_improved = True
+        while is_improved:
+            is_improved = False
+            for i in range(len(ordered) - 1):
+                for j in range(i + 2, len(ordered) + 1):
+                    candidate = ordered[:i] + ordered[i:j][::-1] + ordered[j:]
+                    candidate_travel = BatchPlanner.travel(
+                        candidate, start_position)
+                    if candidate_travel < best_travel - 1e-6:
+                        ordered, best_travel = candidate, candidate_travel
+                        is_improved = True
+        return ordered
+
+    def plan(self, targets: np.ndarray, supply_eggs: list[SupplyEgg],
+             start_joints: list[float] | None = None) -> BatchPlan:
+        targets = np.asarray(targets, dtype=np.float64).reshape(-1, 2)
+        if start_joints is None:
+            start_joints = self.motion_planner.current_joints()
+        # Unknown start: ordered as if from home, the first trip still lifts to safe Z
+        position_joints = start_joints if start_joints is not None else MotionPlanner.HOME_JOINTS
+        start_position = np.array(self.motion_planner.kinematics.forward(
+            position_joints[0], position_joints[2]))
+
+        trips = self.order(self.assign(targets, supply_eggs), start_position)
+
+        commands = []
+        sequential_time = 0.0
+        joints = start_joints
+        for i, trip in enumerate(trips):
+            motion_plan = self.motion_planner.plan_pick_and_place(
+                trip.supply_egg, trip.target[0], trip.target[1],
+                start_joints=joints, return_home=i == len(trips) - 1)
+            trip.motion_plan = motion_plan
+            commands.extend(motion_plan.commands)
+            joints = motion_plan.final_joints
+
+            # What the same trip costs filling one hole per inspection cycle
+            sequential_time += self.motion_planner.plan_pick_and_place(
+                trip.supply_egg, trip.target[0], trip.target[1],
+                start_joints=MotionPlanner.HOME_JOINTS).estimated_time_seconds + \
+                BatchPlanner.INSPECTION_TIME_SECONDS
+
+        return BatchPlan(trips,
+                         self.motion_planner.estimate(commands, position_joints),
+                         BatchPlanner.travel(trips, start_position),
+                         sequential_time)
+
+
+if __name__ == "__main__":
+    from scara_robot import ScaraRobot
+    from supply_egg import SupplySystem
+
+    class GCodeBuilder(ScaraRobot):
+        # Only builds G-code strings, no serial port needed
+        def __init__(self):
+            self.state = None
+
+    batch_planner = BatchPlanner(MotionPlanner(GCodeBuilder()))
+    supply_system = SupplySystem(state_file=None)
+    holes = np.array(((-40, 250), (40, 250), (-40, 200), (40, 200)))
+
+    batch_plan = batch_planner.plan(holes, supply_system.remaining_supply_eggs())
+    for trip in batch_plan.trips:
+        print(f"supply egg {trip.supply_egg.key} -> "
+              f"hole {trip.target_index} ({trip.target[0]:.0f}, {trip.target[1]:.0f})")
+    print(f"travel: {batch_plan.travel_mm:.0f} mm | "
+          f"one by one: {batch_plan.sequential_eggs_per_minute:.2f} eggs/min | "
+          f"batch: {batch_plan.eggs_per_minute:.2f} eggs/min")
@@ -1,7 +1,18 @@
 from roi import ROI
+from frame_grabber import FrameGrabber
+from reference_system import ReferenceSystem
+from supply_egg import SupplySystem
 
+frame_grabber = FrameGrabber(2)
+
+# Every ROI the headless runner needs, it can't ask for them itself
 eggs_roi = ROI("eggs")
-circles_roi = ROI("circles")
+eggs_roi.save(frame_grabber)
+
+for marker in ReferenceSystem.load_markers():
+    ROI(marker["label"]).save(frame_grabber)
+
+if SupplySystem.DETECTION:
+    ROI("supply").save(frame_grabber)
 
-eggs_roi.save()
-circles_roi.save()
\ No newline at end of file
+frame_grabber.release()
@@ -0,0 +1,200 @@
+import datetime
+import glob
+import json
+import os
+import tempfile
+import threading
+from dotenv import dotenv_values
+
+config = dotenv_values(".env")
+
+
+class CalibrationStore:
+    SCHEMA_VERSION: int = 1
+
+    path: str
+    data: dict
+    mtime: float | None
+
+    def __init__(self, path: str = "calibration.json"):
+        self.path = path
+        self.mtime = None
+        self._lock = threading.RLock()
+        self.data = self._empty()
+        self.load()
+
+    @staticmethod
+    def _now() -> str:
+        return datetime.datetime.now().isoformat(timespec="seconds")
+
+    def _empty(self) -> dict:
+        return {
+            "version": CalibrationStore.SCHEMA_VERSION,
+            "revision": 0,
+            "camera_id": None,
+            "updated_at": None,
+            "rois": {},
+            "reference_circles": {},
+            "homography": None,
+            "lens": None,
+        }
+
+    def load(self):
+        with self._lock:
+            if not os.path.exists(self.path):
+                self.data = self._empty()
+                if self._import_legacy_files():
+                    self.save()
+                return
+            with open(self.path) as f:
+                data = json.load(f)
+            if data.get("version") != CalibrationStore.SCHEMA_VERSION:
+                raise ValueError(
+                    f"Unsupported calibration version {data.get('version')} in {self.path}")
+            self.data = data
+            self.mtime = os.path.getmtime(self.path)
+
+    def reload_if_changed(self) -> bool:
+        with self._lock:
+            try:
+                mtime = os.path.getmtime(self.path)
+            except OSError:
+                return False
+            if mtime == self.mtime:
+                return False
+            try:
+                self.load()
+            except (ValueError, OSError) as e:
+                print(f"Couldn't reload calibration: {e}")
+                return False
+            return True
+
+    def save(self):
+        with self._lock:
+            self.data["revision"] += 1
+            self.data["updated_at"] = CalibrationStore._now()
+            # Write to a temporary file next to the target and rename it, so
+            # readers never see a partially written calibration
+            directory = os.path.dirname(os.path.abspath(self.path))
+            fd, temporary_path = tempfile.mkstemp(
+                dir=directory, prefix=".calibration-", suffix=".json")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(self.data, f, indent=2)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temporary_path, self.path)
+            except Exception:
+                os.remove(temporary_path)
+                raise
+            self.mtime = os.path.getmtime(self.path)
+
+    def _import_legacy_files(self) -> bool:
+        imported = False
+        for path in glob.glob("roi_*.txt"):
+            label = os.path.basename(path)[len("roi_"):-len(".txt")]
+            try:
+                with open(path) as f:
+                    x, y, width, height = [
+                        int(i) for i in f.read().rstrip("\n").split(",")]
+            except Exception:
+                continue
+            self._set_roi(label, x, y, width, height)
+            imported = True
+        for path in glob.glob("position_camera_*.txt"):
+            label = os.path.basename(path)[len("position_camera_"):-len(".txt")]
+            try:
+                with open(path) as f:
+                    x, y, radius = [
+                        int(i) for i in f.read().rstrip("\n").split(",")]
+            except Exception:
+                continue
+            self._set_reference_circle(label, x, y, radius)
+            imported = True
+        return imported
+
+    def set_camera_id(self, camera_id):
+        with self._lock:
+            if self.data["camera_id"] != camera_id:
+                self.data["camera_id"] = camera_id
+                self.save()
+
+    def get_roi(self, label: str) -> tuple[int, int, int, int] | None:
+        with self._lock:
+            roi = self.data["rois"].get(label)
+            if roi is None:
+                return None
+            return roi["x"], roi["y"], roi["width"], roi["height"]
+
+    def _set_roi(self, label: str, x: int, y: int, width: int, height: int):
+        self.data["rois"][label] = {
+            "x": int(x), "y": int(y), "width": int(width), "height": int(height),
+            "updated_at": CalibrationStore._now(),
+        }
+
+    def set_roi(self, label: str, x: int, y: int, width: int, height: int):
+        with self._lock:
+            self._set_roi(label, x, y, width, height)
+            self.save()
+
+    def get_reference_circle(self, label: str) -> tuple[float, float, float] | None:
+        with self._lock:
+            circle = self.data["reference_circles"].get(label)
+            if circle is None:
+                return None
+            return circle["x"], circle["y"], circle["radius"]
+
+    def _set_reference_circle(self, label: str, x: float, y: float, radius: float,
+                              quality: float | None = None):
+        # Sub-pixel centres, older files with integers load the same way
+        self.data["reference_circles"][label] = {
+            "x": round(float(x), 2), "y": round(float(y), 2), "radius": round(float(radius), 2),
+            "quality": None if quality is None else round(float(quality), 3),
+            "updated_at": CalibrationStore._now(),
+        }
+
+    def set_reference_circle(self, label: str, x: float, y: float, radius: float, /,
+                             quality: float | None = None):
+        with self._lock:
+            self._set_reference_circle(label, x, y, radius, quality)
+            self.save()
+
+    def get_homography(self, source_points: list) -> list | None:
+        # Only valid if it was computed from the same reference circle positions
+        with self._lock:
+            homography = self.data["homography"]
+            if homography is None or homography["source_points"] != source_points:
+                return None
+            return homography["matrix"]
+
+    def set_homography(self, matrix: list, source_points: list, /,
+                       residuals_mm: dict[str, float] | None = None):
+        with self._lock:
+            self.data["homography"] = {
+                "matrix": matrix,
+                "source_points": source_points,
+                "residuals_mm": residuals_mm,
+                "updated_at": CalibrationStore._now(),
+            }
+            self.save()
+
+    def get_lens(self) -> dict | None:
+        with self._lock:
+            return self.data.get("lens")
+
+    def set_lens(self, camera_matrix: list, dist_coeffs: list, image_size: tuple[int, int], rms: float):
+        with self._lock:
+            self.data["lens"] = {
+                "camera_matrix": camera_matrix,
+                "dist_coeffs": dist_coeffs,
+                "image_size": list(image_size),
+                "rms": round(float(rms), 4),
+                "updated_at": CalibrationStore._now(),
+            }
+            # The homography was fitted on points with the old distortion model
+            self.data["homography"] = None
+            self.save()
+
+
+calibration_store = CalibrationStore(
+    config.get("CALIBRATION_FILE", "calibration.json"))
@@ -1,19 +1,46 @@
 import serial
+import threading
 import time
+from typing import Callable
 
 
 class ConveyerBelt:
     serial_port = serial.Serial
+    is_moving: bool
+    state_timestamp: float
 
-    def __init__(self, port: str, baudrate: int):
-        self.serial_port = serial.Serial(port, baudrate, timeout=1.0)
-        time.sleep(2)
+    def __init__(self, port: str, baudrate: int, /, reset_delay: float = 2.0):
+        self.serial_port = serial.serial_for_url(port, baudrate, timeout=1.0)
+        time.sleep(reset_delay)
+        # The firmware doesn't answer, this is the last commanded state
+        self.is_moving = False
+        self.state_timestamp = time.monotonic()
+        self._state_callbacks = []
+        self._lock = threading.Lock()
+
+    def add_state_callback(self, callback: Callable[[bool], None]):
+        self._state_callbacks.append(callback)
+
+    def _command(self, is_moving: bool):
+        with self._lock:
+            self.serial_port.write(b"1" if is_moving else b"0")
+            is_changed = is_moving != self.is_moving
+            self.is_moving = is_moving
+            if is_changed:
+                self.state_timestamp = time.monotonic()
+        if is_changed:
+            for callback in self._state_callbacks:
+                callback(is_moving)
 
     def move(self):
-        self.serial_port.write(b"1")
+        self._command(True)
 
     def stop(self):
-        self.serial_port.write(b"0")
+        self._command(False)
+
+    def close(self):
+        self.stop()
+        self.serial_port.close()
 
 
 if __name__ == "__main__":
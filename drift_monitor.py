@@ -0,0 +1,141 @@
+import os
+import threading
+import time
+import numpy as np
+from typing import Callable
+from dotenv import dotenv_values
+from frame_grabber import FrameGrabber
+from reference_system import ReferenceSystem
+from reference_locator import ReferenceLocator
+from instrumentation import instrumentation
+
+config = dotenv_values(".env")
+
+
+class DriftMonitor:
+    INTERVAL_SECONDS: float = float(config.get("DRIFT_INTERVAL_SECONDS", 30))
+    FRAMES: int = 3
+    # How far a circle may move from where the calibration saw it before a
+    # correction, the calibration's own fit residuals don't count
+    THRESHOLD_MM: float = float(config.get("DRIFT_THRESHOLD_MM", 1.5))
+    # Beyond this the camera moved too much to trust an automatic correction
+    MAX_CORRECTION_MM: float = float(config.get("DRIFT_MAX_CORRECTION_MM", 15))
+    AUTO_CORRECT: bool = config.get("DRIFT_AUTO_CORRECT", "true").lower() == "true"
+    # The arm can hide a circle for a while, only alarm if it stays hidden
+    MAX_MISSED_CHECKS: int = 3
+
+    frame_grabber: FrameGrabber
+    reference_system: ReferenceSystem
+    interval_seconds: float
+    auto_correct: bool
+    max_error_mm: float | None
+    thread: threading.Thread | None
+
+    def __init__(self, frame_grabber: FrameGrabber, reference_system: ReferenceSystem, /,
+                 interval_seconds: float = INTERVAL_SECONDS, auto_correct: bool = AUTO_CORRECT):
+        self.frame_grabber = frame_grabber
+        self.reference_system = reference_system
+        self.interval_seconds = interval_seconds
+        self.auto_correct = auto_correct
+        self.max_error_mm = None
+        self.missed_checks = 0
+        self._event_callbacks = []
+        self._stop_event = threading.Event()
+        self.thread = None
+
+    def add_event_callback(self, callback: Callable[[str, dict], None]):
+        self._event_callbacks.append(callback)
+
+    def emit(self, name: str, **fields):
+        for callback in self._event_callbacks:
+            callback(name, fields)
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self._stop_event.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _run(self):
+        try:
+            # Below the capture, inference and GUI threads
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 10)
+        except (AttributeError, OSError):
+            pass
+        while not self._stop_event.wait(self.interval_seconds):
+            try:
+                with instrumentation.span("drift_check"):
+                    self.check()
+            except Exception as e:
+                self.emit("drift_alarm", reason="error", error=str(e))
+
+    def drift_errors(self, positions_camera: dict[str, np.ndarray]) -> dict[str, float]:
+        # Each circle's shift from its calibrated camera position, in mm on the belt.
+        # Against the robot positions, more than 4 markers never fit exactly
+        circles = [circle for circle in self.reference_system.references
+                   if circle.label in positions_camera and circle.position_camera is not None]
+        if not circles:
+            return {}
+        positions_robot = self.reference_system.get_robot_coordinates_batch(
+            self.reference_system.undistort_points([positions_camera[circle.label] for circle in circles]))
+        calibrated_robot = self.reference_system.get_robot_coordinates_batch(
+            self.reference_system.undistort_points([circle.position_camera for circle in circles]))
+        return {circle.label: float(np.linalg.norm(position - calibrated))
+                for circle, position, calibrated in zip(circles, positions_robot, calibrated_robot)}
+
+    def check(self):
+        frames = self.frame_grabber.read_frames(DriftMonitor.FRAMES)
+        if not frames:
+            return
+        # Only the small circle ROIs are searched, inference keeps running meanwhile
+        detections = self.reference_system.locator.locate(
+            {circle.label: circle.roi for circle in self.reference_system.references}, frames)
+        located = ReferenceLocator.reliable(detections)
+        missing = sorted(set(detections) - set(located))
+        errors = self.drift_errors(
+            {label: detection.position for label, detection in located.items()})
+
+        if missing:
+            self.missed_checks += 1
+            if self.missed_checks >= DriftMonitor.MAX_MISSED_CHECKS:
+                self.emit("drift_alarm", reason="references_not_found", missing=missing)
+        else:
+            self.missed_checks = 0
+        if not errors:
+            return
+        self.max_error_mm = max(errors.values())
+        self.emit("drift_checked", max_error_mm=round(self.max_error_mm, 2), missing=missing)
+        if self.max_error_mm <= DriftMonitor.THRESHOLD_MM:
+            return
+
+        errors = {label: round(error, 2) for label, error in errors.items()}
+        if missing or not self.auto_correct or self.max_error_mm > DriftMonitor.MAX_CORRECTION_MM:
+            self.emit("drift_alarm", reason="drift", errors_mm=errors, missing=missing)
+            return
+        if not self.reference_system.apply_detections(located):
+            self.emit("drift_alarm", reason="homography_failed", errors_mm=errors)
+            return
+        # The circles are at their calibrated positions again, only the fit's residuals remain
+        self.max_error_mm = 0.0
+        self.emit("recalibrated", errors_mm=errors,
+                  max_residual_mm=max(self.reference_system.residuals_mm.values(), default=0.0))
+
+
+if __name__ == "__main__":
+    frame_grabber = FrameGrabber(2)
+    reference_system = ReferenceSystem(frame_grabber)
+    drift_monitor = DriftMonitor(frame_grabber, reference_system, interval_seconds=5)
+    drift_monitor.add_event_callback(lambda name, fields: print(name, fields))
+    drift_monitor.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        drift_monitor.stop()
+        frame_grabber.release()
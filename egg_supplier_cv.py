@@ -2,32 +2,50 @@ import tkinter as tk
 from tkinter import ttk
 import cv2
 import threading
-from PIL import Image, ImageTk
-import re
+import queue
 from reference_system import ReferenceSystem, ReferenceCircle
-from predicter import EggPredicter
+from predicter import EggPredicter, PredictionPipeline
 from conveyer_belt import ConveyerBelt
-from scara_robot import ScaraRobot
+from scara_robot import ScaraRobot, RobotCommand
 from supply_egg import SupplySystem
+from motion_planner import MotionPlanner
+from supply_routine import SupplyRoutine, RoutineEvent
+from frame_grabber import FrameGrabber
+from tracker import PredictionTracker
+from prediction import PredictionBatch
+from calibration_store import calibration_store
+from instrumentation import instrumentation
+from frame_display import FrameDisplay
+from overlay import OverlayLayer
+from drift_monitor import DriftMonitor
+from lens_calibration import LensCalibration
 
 
 class EggSupplierCV:
     window: tk.Tk
-    video_capture: cv2.VideoCapture
+    frame_grabber: FrameGrabber
     camera_thread: threading.Thread
+    frame_display: FrameDisplay
+    overlay: OverlayLayer
     reference_system: ReferenceSystem
+    drift_monitor: DriftMonitor
+    drift_events: queue.Queue
+    calibration_state: tk.StringVar
     egg_predicter: EggPredicter
+    prediction_pipeline: PredictionPipeline
+    tracker: PredictionTracker
     confidence_threshold: tk.DoubleVar
-    belt: ConveyerBelt
+    inference_concurrency: tk.IntVar
+    belt: ConveyerBelt | None
     scara_robot: ScaraRobot
     supply_system = SupplySystem
-    is_robot_busy: bool
-
-    is_routine_running: bool
-    continue_routine: bool
-    is_conveyer_running: bool
-
-    robot_status: int
+    motion_planner: MotionPlanner
+    supply_routine: SupplyRoutine
+    routine_events: queue.Queue
+    routine_state: tk.StringVar
+    batch_filling: tk.BooleanVar
+    continuous_belt: tk.BooleanVar
+    belt_state: tk.StringVar
 
     robot_x: tk.DoubleVar
     robot_y: tk.DoubleVar
@@ -47,7 +65,9 @@ class EggSupplierCV:
                          if self.is_predicter_running else self.start_thread())
         self.window.minsize(1100, 580)
 
-        self.video_capture = cv2.VideoCapture(video_source)
+        self.frame_grabber = FrameGrabber(video_source)
+        calibration_store.set_camera_id(video_source)
+        self.frame_sequence = 0
 
         self.root_frame = ttk.Frame(self.window, padding=10)
         self.root_frame.grid(sticky=tk.NSEW)
@@ -55,9 +75,27 @@ class EggSupplierCV:
         self.confidence_threshold = tk.DoubleVar()
         self.confidence_threshold.set(0.50)
         self.egg_predicter = EggPredicter(
-            self.confidence_threshold.get(), self.video_capture)
-
-        self.robot_status = 0
+            self.confidence_threshold.get(), self.frame_grabber)
+        self.inference_concurrency = tk.IntVar()
+        self.inference_concurrency.set(2)
+        self.prediction_pipeline = PredictionPipeline(
+            self.egg_predicter, self.inference_concurrency.get())
+        self.predictions = PredictionBatch()
+        self.predictions_sequence = 0
+        self.tracker = PredictionTracker()
+
+        self.routine_events = queue.Queue()
+        self.routine_state = tk.StringVar()
+        self.routine_state.set("Rutina: detenida")
+        self.batch_filling = tk.BooleanVar()
+        self.batch_filling.set(False)
+        self.continuous_belt = tk.BooleanVar()
+        self.continuous_belt.set(False)
+        self.belt_state = tk.StringVar()
+        self.belt_state.set("Cinta: no conectada")
+        self.drift_events = queue.Queue()
+        self.calibration_state = tk.StringVar()
+        self.calibration_state.set("Calibración: sin verificar")
         self.robot_x = tk.DoubleVar()
         self.robot_y = tk.DoubleVar()
         self.robot_z = tk.DoubleVar()
@@ -66,30 +104,39 @@ class EggSupplierCV:
         self.robot_j3 = tk.DoubleVar()
         self.robot_j4 = tk.DoubleVar()
 
+        # Before the widgets, they get one button per reference circle
+        self.reference_system = ReferenceSystem(self.frame_grabber)
+
         self._create_camera_frame()
         self._create_robot_frame()
 
         self.thread = None
         self.is_predicter_running = False
-        self.is_routine_running = False
-        self.continue_routine = False
-        self.is_conveyer_running = False
-
-        self.reference_system = ReferenceSystem(self.video_capture)
-
-        for circle in (self.reference_system.reference_1,
-                       self.reference_system.reference_2,
-                       self.reference_system.reference_3,
-                       self.reference_system.reference_4):
-            while circle.position_camera is None:
-                circle.update_roi(self.video_capture)
-                circle.update_position_camera(self.video_capture)
-                print(circle.position_camera)
-
-        # self.belt = ConveyerBelt(belt_port, 115200)
+
+        # Circles are located automatically, only missing ROIs ask the operator
+        self.locate_reference_circles()
+        self.drift_monitor = DriftMonitor(self.frame_grabber, self.reference_system)
+        self.drift_monitor.add_event_callback(
+            lambda name, fields: self.drift_events.put((name, fields)))
+
+        # Without a belt port the carton is fed by hand
+        self.belt = ConveyerBelt(belt_port, 115200) if belt_port else None
         self.scara_robot = ScaraRobot(robot_port, 115200)
         self.supply_system = SupplySystem()
-        self.is_robot_busy = False
+        if SupplySystem.DETECTION:
+            self.supply_system.enable_detection(self.frame_grabber)
+            self.egg_predicter.supply_roi = self.supply_system.supply_roi
+        self.overlay = OverlayLayer([*self.reference_system.references, self.egg_predicter.eggs_roi])
+        if self.supply_system.supply_roi is not None:
+            self.overlay.drawables.append(self.supply_system.supply_roi)
+        self.motion_planner = MotionPlanner(self.scara_robot)
+        # The routine runs on its own thread, the GUI only observes its events
+        self.supply_routine = SupplyRoutine(
+            self.frame_grabber, self.prediction_pipeline, self.reference_system,
+            self.supply_system, self.motion_planner, tracker=self.tracker,
+            belt=self.belt, batch_filling=self.batch_filling.get(),
+            continuous_belt=self.continuous_belt.get())
+        self.supply_routine.add_event_callback(self.routine_events.put)
 
         self.callbacks_ids = []
 
@@ -99,11 +146,12 @@ class EggSupplierCV:
         self.camera_frame = ttk.Frame(self.root_frame, padding=10)
         self.camera_frame.grid(row=0, column=0, sticky=tk.NS)
 
-        self.camera_canvas = tk.Canvas(
-            self.camera_frame,
-            width=self.video_capture.get(cv2.CAP_PROP_FRAME_WIDTH),
-            height=self.video_capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.camera_canvas = tk.Canvas(self.camera_frame)
         self.camera_canvas.grid(row=0, column=0, columnspan=5)
+        self.frame_display = FrameDisplay(
+            self.camera_canvas,
+            int(self.frame_grabber.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            int(self.frame_grabber.get(cv2.CAP_PROP_FRAME_HEIGHT)))
 
         ttk.Label(self.camera_frame, text="Actualizar ROIs").grid(
             row=1, columnspan=5, pady=10, sticky=tk.NS)
@@ -115,33 +163,13 @@ class EggSupplierCV:
         self.update_eggs_roi_button.grid(
             row=2, column=0, padx=2, sticky=tk.NSEW)
 
-        self.update_reference_1_roi_button = ttk.Button(
-            self.camera_frame,
-            text="Referencia 1",
-            command=lambda: self.update_circle_roi(self.reference_system.reference_1))
-        self.update_reference_1_roi_button.grid(
-            row=2, column=1, padx=2, sticky=tk.NSEW)
-
-        self.update_reference_2_roi_button = ttk.Button(
-            self.camera_frame,
-            text="Referencia 2",
-            command=lambda: self.update_circle_roi(self.reference_system.reference_2))
-        self.update_reference_2_roi_button.grid(
-            row=2, column=2, padx=2, sticky=tk.NSEW)
-
-        self.update_reference_3_roi_button = ttk.Button(
-            self.camera_frame,
-            text="Referencia 3",
-            command=lambda: self.update_circle_roi(self.reference_system.reference_3))
-        self.update_reference_3_roi_button.grid(
-            row=2, column=3, padx=2, sticky=tk.NSEW)
-
-        self.update_reference_4_roi_button = ttk.Button(
-            self.camera_frame,
-            text="Referencia 4",
-            command=lambda: self.update_circle_roi(self.reference_system.reference_4))
-        self.update_reference_4_roi_button.grid(
-            row=2, column=4, padx=2, sticky=tk.NSEW)
+        # One button per reference marker, however many are configured
+        for i, circle in enumerate(self.reference_system.references):
+            ttk.Button(
+                self.camera_frame,
+                text=f"Referencia {i + 1}",
+                command=lambda circle=circle: self.update_circle_roi(circle)).grid(
+                row=2, column=i + 1, padx=2, sticky=tk.NSEW)
 
         self.confidence_threshold_string = tk.StringVar()
         self.confidence_threshold_string.set(
@@ -156,6 +184,29 @@ class EggSupplierCV:
         self.confidence_threshold_scale.grid(
             row=3, column=2, columnspan=3, sticky=tk.EW, padx=4)
 
+        self.inference_concurrency_string = tk.StringVar()
+        self.inference_concurrency_string.set(
+            f"Inferencias en paralelo ({self.inference_concurrency.get()})")
+        self.inference_concurrency_label = ttk.Label(
+            self.camera_frame, textvariable=self.inference_concurrency_string)
+        self.inference_concurrency_label.grid(
+            row=4, column=0, columnspan=2, sticky=tk.W)
+
+        self.inference_concurrency_scale = ttk.Scale(
+            self.camera_frame, from_=1, to=PredictionPipeline.MAX_CONCURRENCY, variable=self.inference_concurrency, command=self.update_inference_concurrency)
+        self.inference_concurrency_scale.grid(
+            row=4, column=2, columnspan=3, sticky=tk.EW, padx=4)
+
+        self.inference_throughput_string = tk.StringVar()
+        ttk.Label(self.camera_frame, textvariable=self.inference_throughput_string).grid(
+            row=5, column=0, columnspan=5, pady=10, sticky=tk.W)
+
+        self.stats_string = tk.StringVar()
+        ttk.Label(self.camera_frame, textvariable=self.stats_string, font=("Courier", 9),
+                  justify=tk.LEFT).grid(row=6, column=0, columnspan=4, sticky=tk.W)
+        ttk.Button(self.camera_frame, text="Exportar métricas", command=self.export_stats).grid(
+            row=6, column=4, sticky=tk.NE, padx=2)
+
     def _create_robot_frame(self):
         self.robot_frame = ttk.Frame(self.root_frame, padding=10)
         self.robot_frame.grid(row=0, column=1, sticky=tk.NS)
@@ -172,10 +223,29 @@ class EggSupplierCV:
             row=1, column=0, columnspan=2, sticky=tk.EW, pady=2)
 
         self.robot_start_routine_button = ttk.Button(
-            self.robot_frame, text="Iniciar rutina", command=self.run_supply_egg)
+            self.robot_frame, text="Iniciar rutina", command=self.toggle_supply_routine)
         self.robot_start_routine_button.grid(
             row=2, column=0, columnspan=2, sticky=tk.EW, pady=2)
 
+        ttk.Checkbutton(self.robot_frame, text="Llenado por lotes", variable=self.batch_filling,
+                        command=self.update_batch_filling).grid(
+            row=17, column=0, columnspan=2, sticky=tk.W, pady=10)
+        ttk.Checkbutton(self.robot_frame, text="Cinta continua", variable=self.continuous_belt,
+                        command=self.update_continuous_belt).grid(
+            row=18, column=0, columnspan=2, sticky=tk.W)
+        ttk.Label(self.robot_frame, textvariable=self.routine_state).grid(
+            row=19, column=0, columnspan=2, sticky=tk.W, pady=2)
+        ttk.Label(self.robot_frame, textvariable=self.belt_state).grid(
+            row=20, column=0, columnspan=2, sticky=tk.W, pady=2)
+
+        self.supply_state = tk.StringVar()
+        ttk.Label(self.robot_frame, textvariable=self.supply_state).grid(
+            row=21, column=0, columnspan=2, sticky=tk.W, pady=2)
+        ttk.Button(self.robot_frame, text="Reponer bandejas", command=self.refill_supply).grid(
+            row=22, column=0, columnspan=2, sticky=tk.EW, pady=2)
+        ttk.Label(self.robot_frame, textvariable=self.calibration_state).grid(
+            row=23, column=0, columnspan=2, sticky=tk.W, pady=2)
+
         self.g_code_text = tk.Text(
             self.robot_frame, wrap=tk.WORD, height=10, width=40)
         self.g_code_scrollbar = ttk.Scrollbar(
@@ -224,35 +294,43 @@ class EggSupplierCV:
             row=16, columnspan=2, pady=2, sticky=tk.EW)
 
     def update(self):
-        _, frame = self.video_capture.read()
+        self.frame_sequence, frame_timestamp, frame = self.frame_grabber.read_newer(
+            self.frame_sequence, timeout=0)
 
         if frame is not None:
-            self.reference_system.reference_1.draw(frame)
-            self.reference_system.reference_2.draw(frame)
-            self.reference_system.reference_3.draw(frame)
-            self.reference_system.reference_4.draw(frame)
-
-            self.egg_predicter.eggs_roi.draw(frame)
-
-            try:
-                self.predictions = self.egg_predicter.predict(frame)
-                for i, p in enumerate(self.predictions):
-                    target_point_robot = self.reference_system.get_robot_coordinates(
-                        p.cx, p.cy)
-                    p.draw(frame, number=i)
-                    cv2.putText(frame,
-                                f"{i}: ({target_point_robot[0]:.2f},{target_point_robot[1]:.2f})",
-                                (450, 470-20*i),
-                                cv2.FONT_ITALIC,
-                                fontScale=0.55,
-                                color=(0, 0, 255),
-                                thickness=2)
-            except Exception as e:
-                print(e)
-
-            self.tkinter_image = self.convert_to_tkinter_image(frame)
-            self.camera_canvas.create_image(
-                0, 0, anchor=tk.NW, image=self.tkinter_image)
+            self.prediction_pipeline.submit(
+                self.frame_sequence, frame, frame_timestamp,
+                use_cache=not self.continuous_belt.get())
+
+        # Inference takes every frame, drawing only the ones that get displayed
+        if frame is not None and self.frame_display.wants_frame():
+            with instrumentation.span("draw"):
+                frame = self.overlay.compose(frame)
+                try:
+                    # The tracker is fed by the supply routine, the GUI only draws
+                    self.predictions_sequence, self.predictions = self.prediction_pipeline.latest()
+                    self.predictions.draw(frame, numbered=True)
+                    targets_point_robot = self.predictions.robot_coordinates(
+                        self.reference_system)
+                    for i, target_point_robot in enumerate(targets_point_robot):
+                        cv2.putText(frame,
+                                    f"{i}: ({target_point_robot[0]:.2f},{target_point_robot[1]:.2f})",
+                                    (450, 470-20*i),
+                                    cv2.FONT_ITALIC,
+                                    fontScale=0.55,
+                                    color=(0, 0, 255),
+                                    thickness=2)
+                except Exception as e:
+                    print(e)
+
+            throughput = f"Inferencia: {self.egg_predicter.crops_per_second:.1f} recortes/s"
+            if self.egg_predicter.prediction_cache is not None:
+                cache = self.egg_predicter.prediction_cache
+                throughput += f" | Cache: {cache.hits} aciertos, {cache.misses} fallos"
+            self.inference_throughput_string.set(throughput)
+
+            with instrumentation.span("tk_convert"):
+                self.frame_display.update(frame)
         if self.is_predicter_running:
             self.window.after(10, self.update)
 
@@ -270,36 +348,80 @@ class EggSupplierCV:
             self.thread.join()
 
     def on_close(self):
+        self.supply_routine.stop()
+        self.drift_monitor.stop()
         self.stop_thread()
-        self.scara_robot.serial_port.close()
-        self.video_capture.release()
+        self.prediction_pipeline.shutdown()
+        self.reference_system.locator.shutdown()
+        self.scara_robot.close()
+        if self.belt is not None:
+            self.belt.close()
+        self.frame_grabber.release()
         self.window.destroy()
 
-    def convert_to_tkinter_image(self, frame):
-        image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        image = Image.fromarray(image)
-        photo = ImageTk.PhotoImage(image=image)
-        return photo
-
     def run(self):
         self.update()
         self.start_thread()
+        self.watch_calibration()
+        self.drift_monitor.start()
+        self.update_robot_state()
+        self.watch_supply_routine()
+        self.update_stats()
         self.window.mainloop()
 
+    def watch_calibration(self):
+        if calibration_store.reload_if_changed():
+            print("calibration changed, reloading")
+            self.egg_predicter.eggs_roi.reload()
+            self.egg_predicter.lens = LensCalibration.load()
+            if self.egg_predicter.prediction_cache is not None:
+                self.egg_predicter.prediction_cache.invalidate()
+            self.reference_system.reload_calibration()
+            self.overlay.invalidate()
+        while True:
+            try:
+                name, fields = self.drift_events.get_nowait()
+            except queue.Empty:
+                break
+            print(name, fields)
+            if name == "drift_checked":
+                self.calibration_state.set(
+                    f"Calibración: deriva {fields['max_error_mm']:.2f} mm")
+            elif name == "recalibrated":
+                self.overlay.invalidate()
+                self.calibration_state.set(
+                    f"Calibración: corregida ({max(fields['errors_mm'].values()):.2f} mm)")
+            elif name == "drift_alarm":
+                self.calibration_state.set(f"Calibración: ¡alarma! ({fields['reason']})")
+        self.window.after(1000, self.watch_calibration)
+
+    def locate_reference_circles(self):
+        # A few automatic attempts, then the circles not found get their ROIs redrawn
+        while True:
+            for _ in range(ReferenceSystem.MAX_ATTEMPTS):
+                if self.reference_system.locate_reference_circles(self.frame_grabber):
+                    return
+                print("retrying reference circles")
+            for circle in self.reference_system.missing_references:
+                print(f"{circle.label} not found, select its ROI again")
+                circle.update_roi(self.frame_grabber)
+
     def update_circle_roi(self, circle: ReferenceCircle):
         self.stop_thread()
-        circle.position_camera = None
-        circle.radius_camera = None
-        while circle.position_camera is None:
-            circle.update_roi(self.video_capture)
-            circle.update_position_camera(self.video_capture)
+        circle.update_roi(self.frame_grabber)
+        while not any(circle.update_position_camera(self.frame_grabber)
+                      for _ in range(ReferenceSystem.MAX_ATTEMPTS)):
+            print(f"{circle.label} not found, select its ROI again")
+            circle.update_roi(self.frame_grabber)
         self.reference_system.update_homography_matrix()
+        self.overlay.invalidate()
         self.window.after(500, self.start_thread)
 
     def update_eggs_roi(self):
         self.stop_thread()
-        self.egg_predicter.calibrate_roi(self.video_capture)
-        self.egg_predicter.eggs_roi.load(self.video_capture)
+        self.egg_predicter.calibrate_roi(self.frame_grabber)
+        self.egg_predicter.eggs_roi.load(self.frame_grabber)
+        self.overlay.invalidate()
         self.window.after(500, self.start_thread)
 
     def update_confidence_threshold(self, value: float):
@@ -308,172 +430,94 @@ class EggSupplierCV:
         self.confidence_threshold.set(value)
         self.egg_predicter.set_confidence(value)
 
+    def update_inference_concurrency(self, value: float):
+        concurrency = round(float(value))
+        self.inference_concurrency_string.set(
+            f"Inferencias en paralelo ({concurrency})")
+        self.inference_concurrency.set(concurrency)
+        self.prediction_pipeline.set_concurrency(concurrency)
+
     def update_g_code_text(self, command_sent: str):
         command_sent += "\n"
         self.g_code_text.config(state="normal")
         self.g_code_text.insert(tk.END, command_sent)
         self.g_code_text.config(state="disabled")
 
-    def send_command(self, command=None):
-        self.scara_robot.serial_port.read_all()
-
+    def send_command(self, command=None) -> RobotCommand:
         if command is not None:
             self.terminal_input_entry.delete(0, tk.END)
             self.terminal_input_entry.insert(0, command)
 
         command = self.terminal_input_entry.get().upper()
 
-        # self.scara_robot.serial_port.write((command + "\n").encode())
-        self.scara_robot.send_command(command)
+        robot_command = self.scara_robot.send_command(command)
         self.update_g_code_text(command)
         self.terminal_input_entry.delete(0, tk.END)
         self.terminal_input_entry.focus()
+        return robot_command
 
-        self.callbacks_ids.append(self.window.after(
-            500, self.update_robot_response))
-
-    def run_supply_egg(self):
-        self.is_routine_running = True
-        print("iniciando rutina!")
-        self.is_conveyer_running = True
-        print("Girando cinta!")
-        self.window.after(500, self.predict_holes)
-
-    def predict_holes(self):
-        print("predict holes 1")
-        if not self.is_routine_running:
-            return
-        print("predict holes 2")
-
-        if self.is_robot_busy:
-            self.window.after(1000, self.predict_holes)
-
-        for i in range(2500):
-            # if len(self.predictions) >= 6:
-            if True:
-                self.target_hole = None
-                for prediction in self.predictions:
-                    if prediction.class_label == "hole":
-                        self.target_hole = prediction
-                        print("target hole!")
-                        print("Deteniendo cinta!")
-                        self.stop_thread()
-                        break
-                if self.target_hole is not None:
-                    if self.supply_system.next_egg_index < len(self.supply_system.supply_eggs):
-                        supply_egg = self.supply_system.supply_eggs[self.supply_system.next_egg_index]
-                        target_point_robot = self.reference_system.get_robot_coordinates(
-                            self.target_hole.cx, self.target_hole.cy)
-
-                        self.current_command = 0
-
-                        self.commands_list = (
-                            self.scara_robot.go_to_articular_coordinate(
-                                j2=SupplySystem.SAFE_Z_POSITION_MM),
-                            self.scara_robot.go_to_cartesian_coordinate(
-                                x=supply_egg.grab_x_position_mm,
-                                y=supply_egg.grab_y_position_mm),
-                            self.scara_robot.go_to_articular_coordinate(
-                                j2=SupplySystem.APPROACH_Z_POSITION_MM),
-                            self.scara_robot.go_to_articular_coordinate(
-                                j4=supply_egg.grab_j4_angle_degrees),
-                            self.scara_robot.go_to_articular_coordinate(
-                                j2=SupplySystem.GRAB_Z_POSITION_MM),
-                            self.scara_robot.act_tool(
-                                value=SupplySystem.GRAB_GRIPPER_VALUE),
-                            self.scara_robot.go_to_articular_coordinate(
-                                j2=SupplySystem.SAFE_Z_POSITION_MM),
-                            self.scara_robot.go_to_cartesian_coordinate(
-                                x=target_point_robot[0], y=target_point_robot[1]),
-                            self.scara_robot.go_to_articular_coordinate(
-                                j2=SupplySystem.RELEASE_Z_POSITION_MM),
-                            self.scara_robot.release_tool(),
-                            self.scara_robot.go_to_articular_coordinate(
-                                j2=SupplySystem.SAFE_Z_POSITION_MM),
-                            self.scara_robot.go_to_articular_coordinate(
-                                j1=0,
-                                j3=0)
-                        )
-                    else:
-                        print("no more eggs")
-                        self.commands_list = tuple()
-                        self.start_thread()
-                        break
-                    self.callbacks_ids.append(
-                        self.window.after(500, self.execute_next_command))
-                    self.is_robot_busy = True
-                    break
-        if self.target_hole is None:
-            print("no hueco detectado")
-            if len(self.predictions) == 6:
-                print("plancha completa")
-                print("Moviendo cinta!")
-            self.window.after(1500, self.predict_holes)
-            # self.is_routine_running = False
-
-    def execute_next_command(self):
-        print("execute next command")
-        print(self.robot_status)
-        if self.robot_status == 0:
-            if self.current_command < len(self.commands_list):
-                print(
-                    f"next_command!: {self.commands_list[self.current_command]}")
-                self.send_command(self.commands_list[self.current_command])
-                self.current_command += 1
-                self.callbacks_ids.append(self.window.after(
-                    1000, self.execute_next_command))
-            else:
-                print("huevo entregado")
-                self.commands_list = tuple()
-                self.start_thread()
-                self.window.after(6000, self.predict_holes)
-                self.is_robot_busy = False
-                self.supply_system.next_egg_index += 1
-        elif self.robot_status is None:
-            self.callbacks_ids.append(self.window.after(
-                1000, self.execute_next_command))
-        else:
-            print("cancelling tasks")
-            for task_id in self.callbacks_ids:
-                self.window.after_cancel(task_id)
-            self.callbacks_ids.clear()
-
-    def update_robot_response(self):
-        print("update_robot_response")
-        self.robot_response = self.scara_robot.serial_port.readline(
-        ).decode().rstrip("&\r\n").lstrip("$")
-        print(self.robot_response)
-        if not self.robot_response.startswith("["):
-            # self.robot_response = ""
-            self.callbacks_ids.append(self.window.after(
-                500, self.update_robot_response))
+    def toggle_supply_routine(self):
+        if self.supply_routine.is_running:
+            print("deteniendo rutina")
+            self.supply_routine.stop()
         else:
-            self.is_robot_busy = False
-            self.parse_robot_params()
-
-    def parse_robot_params(self):
-        pattern = r"\[(\d+)\]XYZ:\(([\d.-]+),([\d.-]+),([\d.-]+)\);J1J2J3J4:\(([\d.-]+),([\d.-]+),([\d.-]+),([\d.-]+)\)"
-        match = re.match(pattern, self.robot_response)
-
-        if match:
-            status_number = int(match.group(1))
-            x_coord, y_coord, z_coord = float(match.group(2)), float(
-                match.group(3)), float(match.group(4))
-            j1, j2, j3, j4 = float(match.group(5)), float(
-                match.group(6)), float(match.group(7)), float(match.group(8))
-
-            self.robot_status = status_number
-            self.robot_x.set(x_coord)
-            self.robot_y.set(y_coord)
-            self.robot_z.set(z_coord)
-            self.robot_j1.set(j1)
-            self.robot_j2.set(j2)
-            self.robot_j3.set(j3)
-            self.robot_j4.set(j4)
-            self.robot_response = ""
-        else:
-            self.robot_status = None
+            print("iniciando rutina!")
+            self.supply_routine.start()
+
+    def update_batch_filling(self):
+        self.supply_routine.batch_filling = self.batch_filling.get()
 
+    def refill_supply(self):
+        print("bandejas repuestas")
+        self.supply_system.refill()
+
+    def update_continuous_belt(self):
+        self.supply_routine.continuous_belt = self.continuous_belt.get()
+
+    def watch_supply_routine(self):
+        while True:
+            try:
+                event: RoutineEvent = self.routine_events.get_nowait()
+            except queue.Empty:
+                break
+            if event.name == "program":
+                for command in event.fields["commands"]:
+                    self.update_g_code_text(command)
+            else:
+                print(event)
+        self.routine_state.set(f"Rutina: {self.supply_routine.state.value}")
+        self.supply_state.set(
+            f"Huevos en bandejas: {len(self.supply_system.remaining_supply_eggs())}"
+            f"/{len(self.supply_system.supply_eggs)}")
+        if self.belt is not None:
+            belt_state = "Cinta: en movimiento" if self.belt.is_moving else "Cinta: detenida"
+            velocity = self.tracker.velocity()
+            if velocity is not None:
+                belt_state += f" ({velocity[0]:.0f}, {velocity[1]:.0f}) px/s"
+            self.belt_state.set(belt_state)
+        self.robot_start_routine_button.config(
+            text="Detener rutina" if self.supply_routine.is_running else "Iniciar rutina")
+        self.window.after(100, self.watch_supply_routine)
+
+    def update_stats(self):
+        self.stats_string.set(instrumentation.format_table())
+        self.window.after(1000, self.update_stats)
+
+    def export_stats(self):
+        instrumentation.dump()
+        print(f"metrics saved to {instrumentation.METRICS_FILE}")
+
+    def update_robot_state(self):
+        robot_state = self.scara_robot.state
+        if robot_state is not None:
+            self.robot_x.set(robot_state.x)
+            self.robot_y.set(robot_state.y)
+            self.robot_z.set(robot_state.z)
+            self.robot_j1.set(robot_state.j1)
+            self.robot_j2.set(robot_state.j2)
+            self.robot_j3.set(robot_state.j3)
+            self.robot_j4.set(robot_state.j4)
+        self.window.after(100, self.update_robot_state)
 
 if __name__ == "__main__":
     EggSupplierCV(video_source=2, robot_port="/dev/ttyUSB0").run()
@@ -0,0 +1,56 @@
+import tkinter as tk
+import time
+import cv2
+import numpy as np
+from PIL import Image, ImageTk
+from dotenv import dotenv_values
+
+config = dotenv_values(".env")
+
+
+class FrameDisplay:
+    # Redrawing faster than this only costs CPU, inference keeps its own rate
+    FPS: float = float(config.get("DISPLAY_FPS", 15))
+    SCALE: float = float(config.get("DISPLAY_SCALE", 1.0))
+
+    fps: float
+    size: tuple[int, int]
+    canvas: tk.Canvas
+    photo: ImageTk.PhotoImage
+
+    def __init__(self, canvas: tk.Canvas, width: int, height: int, /,
+                 fps: float = FPS, scale: float = SCALE):
+        self.canvas = canvas
+        self.fps = fps
+        self.size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        self._last_update = 0.0
+
+        # RGBA so PIL maps the numpy buffer instead of copying it,
+        # the frame is converted straight into it every update
+        self._rgba = np.full((self.size[1], self.size[0], 4), 255, dtype=np.uint8)
+        self._scaled = np.empty((self.size[1], self.size[0], 3), dtype=np.uint8)
+        self._image = Image.frombuffer(
+            "RGBA", self.size, self._rgba, "raw", "RGBA", 0, 1)
+
+        # A single photo and canvas item for the whole run, only their pixels change
+        self.photo = ImageTk.PhotoImage("RGBA", self.size)
+        self.canvas.config(width=self.size[0], height=self.size[1])
+        self._item = self.canvas.create_image(0, 0, anchor=tk.NW, image=self.photo)
+
+    def wants_frame(self) -> bool:
+        # 0 or less draws every frame
+        if self.fps <= 0:
+            return True
+        return time.monotonic() - self._last_update >= 1 / self.fps
+
+    def update(self, frame: cv2.typing.MatLike) -> bool:
+        if not self.wants_frame():
+            return False
+        self._last_update = time.monotonic()
+        if (frame.shape[1], frame.shape[0]) != self.size:
+            cv2.resize(frame, self.size, dst=self._scaled,
+                       interpolation=cv2.INTER_AREA)
+            frame = self._scaled
+        cv2.cvtColor(frame, cv2.COLOR_BGR2RGBA, dst=self._rgba)
+        self.photo.paste(self._image)
+        return True
@@ -0,0 +1,135 @@
+import threading
+import time
+import cv2
+import numpy as np
+from instrumentation import instrumentation
+
+
+class FrameGrabber:
+    RING_SIZE: int = 4
+
+    capture: cv2.VideoCapture
+    thread: threading.Thread
+    ring: list[np.ndarray]
+    sequence: int
+    timestamp: float
+    dropped_frames: int
+
+    def __init__(self, video_source=0, ring_size: int = RING_SIZE):
+        self.capture = cv2.VideoCapture(video_source)
+        # Keep the driver queue as short as possible, the ring does the buffering
+        self.capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+
+        self.ring_size = ring_size
+        self.ring = []
+        self.sequence = 0
+        self.timestamp = 0.0
+        self.dropped_frames = 0
+        self._last_read_sequence = 0
+
+        self._condition = threading.Condition()
+        self._is_running = False
+        self.thread = None
+
+        self._preallocate()
+        self.start()
+
+    def _preallocate(self):
+        width = int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        if width <= 0 or height <= 0:
+            return
+        self.ring = [np.empty((height, width, 3), dtype=np.uint8)
+                     for _ in range(self.ring_size)]
+
+    def get(self, property_id: int) -> float:
+        return self.capture.get(property_id)
+
+    def start(self):
+        if self._is_running:
+            return
+        self._is_running = True
+        self.thread = threading.Thread(target=self._grab_loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if not self._is_running:
+            return
+        self._is_running = False
+        self.thread.join()
+
+    def release(self):
+        self.stop()
+        self.capture.release()
+
+    def _grab_loop(self):
+        while self._is_running:
+            slot = (self.sequence + 1) % self.ring_size
+            with instrumentation.span("frame_grab"):
+                if self.ring:
+                    ret, frame = self.capture.read(self.ring[slot])
+                else:
+                    ret, frame = self.capture.read()
+            if not ret or frame is None:
+                time.sleep(0.005)
+                continue
+            if not self.ring:
+                self.ring = [np.empty_like(frame)
+                             for _ in range(self.ring_size)]
+            if frame is not self.ring[slot]:
+                # Resolution changed or the backend ignored the output buffer
+                if frame.shape != self.ring[slot].shape:
+                    self.ring[slot] = np.empty_like(frame)
+                self.ring[slot][...] = frame
+
+            with self._condition:
+                self.sequence += 1
+                self.timestamp = time.monotonic()
+                self._condition.notify_all()
+
+    def read(self) -> tuple[int, float, np.ndarray | None]:
+        with self._condition:
+            if self.sequence == 0:
+                return 0, 0.0, None
+            if self.sequence - self._last_read_sequence > 1:
+                self.dropped_frames += self.sequence - self._last_read_sequence - 1
+            self._last_read_sequence = self.sequence
+            frame = self.ring[self.sequence % self.ring_size].copy()
+            return self.sequence, self.timestamp, frame
+
+    def read_newer(self, sequence: int, timeout: float = 1.0) -> tuple[int, float, np.ndarray | None]:
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.sequence > sequence, timeout):
+                return sequence, self.timestamp, None
+        return self.read()
+
+    def read_frames(self, count: int, timeout: float = 1.0) -> list[np.ndarray]:
+        frames = []
+        sequence, _, frame = self.read()
+        if frame is not None:
+            frames.append(frame)
+        while len(frames) < count:
+            sequence, _, frame = self.read_newer(sequence, timeout)
+            if frame is None:
+                break
+            frames.append(frame)
+        return frames
+
+
+if __name__ == "__main__":
+    frame_grabber = FrameGrabber(2)
+
+    sequence = 0
+    while True:
+        sequence, timestamp, frame = frame_grabber.read_newer(sequence)
+        if frame is None:
+            print("Error reading image from camera")
+            continue
+        cv2.imshow('Frame grabber', frame)
+
+        if cv2.waitKey(1) & 0xFF == ord('q'):
+            break
+
+    print(f"dropped frames: {frame_grabber.dropped_frames}")
+    frame_grabber.release()
+    cv2.destroyAllWindows()
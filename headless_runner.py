@@ -0,0 +1,294 @@
+import argparse
+import json
+import logging
+import time
+from concurrent.futures import CancelledError
+from typing import Callable
+from frame_grabber import FrameGrabber
+from predicter import EggPredicter
+from reference_system import ReferenceSystem
+from scara_robot import ScaraRobot, RobotError
+from supply_egg import SupplySystem
+from motion_planner import MotionPlanner
+from batch_planner import BatchPlanner
+from tracker import PredictionTracker, Track
+from mjpeg_server import MJPEGServer
+from overlay import OverlayLayer
+from drift_monitor import DriftMonitor
+from instrumentation import instrumentation
+
+logger = logging.getLogger("egg_supplier")
+
+
+class HeadlessRunner:
+    COMMAND_TIMEOUT_SECONDS: float = 30.0
+    SUPPLY_POLL_SECONDS: float = 1.0
+
+    frame_grabber: FrameGrabber
+    egg_predicter: EggPredicter
+    reference_system: ReferenceSystem
+    tracker: PredictionTracker
+    scara_robot: ScaraRobot
+    supply_system: SupplySystem
+    motion_planner: MotionPlanner
+    batch_planner: BatchPlanner
+    preview: MJPEGServer | None
+    overlay: OverlayLayer
+    drift_monitor: DriftMonitor
+    is_running: bool
+
+    def __init__(self, /, video_source=0, robot_port: str = "", confidence_threshold: float = 0.5,
+                 preview_port: int | None = None, preview_fps: float = 5.0,
+                 batch_filling: bool = False, metrics_path: str | None = None):
+        self.frame_grabber = FrameGrabber(video_source)
+        # ROIs must already be stored, nothing can be selected without a display
+        self.egg_predicter = EggPredicter(
+            confidence_threshold, self.frame_grabber, interactive=False)
+        self.reference_system = ReferenceSystem(self.frame_grabber, interactive=False)
+        self.tracker = PredictionTracker()
+        self.scara_robot = ScaraRobot(robot_port, 115200)
+        self.supply_system = SupplySystem()
+        if SupplySystem.DETECTION:
+            self.supply_system.enable_detection(self.frame_grabber, interactive=False)
+            self.egg_predicter.supply_roi = self.supply_system.supply_roi
+        self.motion_planner = MotionPlanner(self.scara_robot)
+        self.batch_planner = BatchPlanner(self.motion_planner)
+        self.batch_filling = batch_filling
+        self.metrics_path = metrics_path
+        self.preview = MJPEGServer(preview_port, fps=preview_fps) \
+            if preview_port is not None else None
+        self.overlay = OverlayLayer(
+            [*self.reference_system.references, self.egg_predicter.eggs_roi])
+        self.is_running = False
+
+        # No operator to redraw the ROIs here, give up after a few attempts
+        if any(circle.position_camera is None for circle in self.reference_system.references) \
+                and not any(self.reference_system.locate_reference_circles(self.frame_grabber)
+                            for _ in range(ReferenceSystem.MAX_ATTEMPTS)):
+            raise RuntimeError(
+                "Reference circles not found, check their ROIs with the GUI")
+        self.drift_monitor = DriftMonitor(self.frame_grabber, self.reference_system)
+        self.drift_monitor.add_event_callback(self.on_drift_event)
+
+    def log_event(self, event: str, **fields):
+        logger.info(json.dumps({"time": time.time(), "event": event, **fields}))
+
+    def on_drift_event(self, name: str, fields: dict):
+        if name == "recalibrated":
+            self.overlay.invalidate()
+        self.log_event(name, **fields)
+
+    def run(self):
+        self.is_running = True
+        self.log_event("started")
+        self.drift_monitor.start()
+        sequence = 0
+        tracked_predictions = None
+        try:
+            while self.is_running:
+                sequence, timestamp, frame = self.frame_grabber.read_newer(
+                    sequence)
+                if frame is None:
+                    self.log_event("camera_timeout")
+                    continue
+
+                try:
+                    # Tentative tracks need real detections to be confirmed
+                    predictions = self.egg_predicter.predict(
+                        frame, use_cache=not self.tracker.tentative_tracks())
+                except Exception as e:
+                    self.log_event("prediction_error", error=str(e))
+                    continue
+                # A cache hit hands back the very same batch, it isn't a new detection
+                if predictions is tracked_predictions:
+                    self.tracker.hold()
+                else:
+                    tracked_predictions = predictions
+                    self.tracker.update(predictions)
+
+                if self.preview is not None and self.preview.wants_frame():
+                    preview_frame = self.overlay.compose(frame)
+                    predictions.draw(preview_frame)
+                    self.preview.update(preview_frame)
+
+                holes = self.tracker.confirmed_tracks("hole")
+                if not holes:
+                    continue
+                if self.supply_system.supply_roi is not None:
+                    self.supply_system.detect(
+                        self.egg_predicter.supply_predictions, self.reference_system)
+                if not self.supply_system.remaining_supply_eggs():
+                    self.wait_for_supply(sequence)
+                    # The carton may have moved while waiting
+                    self.reset_inspection()
+                    continue
+                if self.batch_filling:
+                    self.supply_batch(holes, sequence)
+                    continue
+                # The next hole waits for another inspection, the arm can't stay over the carton
+                self.supply_egg(holes[0], sequence)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def wait_for_supply(self, sequence: int):
+        # Same as the routine: hold until a tray is detected full or refilled with --refill
+        self.log_event("supply_empty")
+        last_poll = time.monotonic()
+        while self.is_running and not self.supply_system.remaining_supply_eggs():
+            sequence, _, frame = self.frame_grabber.read_newer(sequence)
+            if time.monotonic() - last_poll <= HeadlessRunner.SUPPLY_POLL_SECONDS:
+                continue
+            last_poll = time.monotonic()
+            # A refill from another process only shows up in the state file
+            self.supply_system.load_state()
+            if frame is None or self.supply_system.supply_roi is None:
+                continue
+            try:
+                self.egg_predicter.predict(frame, use_cache=False)
+            except Exception as e:
+                self.log_event("prediction_error", error=str(e))
+                continue
+            self.supply_system.detect(
+                self.egg_predicter.supply_predictions, self.reference_system)
+        self.log_event("supply_refilled",
+                       remaining=len(self.supply_system.remaining_supply_eggs()))
+
+    def supply_egg(self, target_hole: Track, sequence: int):
+        target_point_robot = self.reference_system.get_robot_coordinates(
+            target_hole.cx, target_hole.cy)
+        supply_egg = self.supply_system.nearest_supply_egg(
+            target_point_robot[0], target_point_robot[1])
+        self.log_event("target_hole", frame=sequence, track=target_hole.track_id,
+                       camera=(target_hole.cx, target_hole.cy),
+                       robot=(round(float(target_point_robot[0]), 2),
+                              round(float(target_point_robot[1]), 2)),
+                       supply_egg=supply_egg.key)
+
+        start_time = time.monotonic()
+        motion_plan = self.motion_planner.plan_pick_and_place(
+            supply_egg, target_point_robot[0], target_point_robot[1],
+            start_joints=self.motion_planner.current_joints())
+        self.log_event("motion_plan", commands=len(motion_plan.commands),
+                       estimated_time=motion_plan.estimated_time_seconds)
+        grab_index = next(i for i, command in enumerate(motion_plan.commands)
+                          if command.startswith("G20"))
+
+        def on_command_done(index: int):
+            # The egg has left the tray once grabbed, whatever happens next
+            if index == grab_index:
+                self.supply_system.mark_used(supply_egg)
+
+        if not self.run_program(motion_plan.commands, on_command_done):
+            self.is_running = False
+            return
+        instrumentation.record("egg_cycle", time.monotonic() - start_time)
+        self.log_event("egg_supplied", duration=time.monotonic() - start_time)
+        self.reset_inspection()
+
+    def supply_batch(self, target_holes: list[Track], sequence: int):
+        targets_point_robot = self.reference_system.get_robot_coordinates_batch(
+            [(hole.cx, hole.cy) for hole in target_holes])
+        batch_plan = self.batch_planner.plan(
+            targets_point_robot, self.supply_system.remaining_supply_eggs())
+        self.log_event("batch_plan", frame=sequence,
+                       tracks=[target_holes[trip.target_index].track_id
+                               for trip in batch_plan.trips],
+                       supply_eggs=[trip.supply_egg.key for trip in batch_plan.trips],
+                       commands=len(batch_plan.motion_plan.commands),
+                       travel=batch_plan.travel_mm,
+                       estimated_time=batch_plan.motion_plan.estimated_time_seconds,
+                       sequential_eggs_per_minute=batch_plan.sequential_eggs_per_minute,
+                       batch_eggs_per_minute=batch_plan.eggs_per_minute)
+
+        # Each egg leaves its tray on its grab, even if a later command fails
+        grabbed_supply_eggs = {}
+        offset = 0
+        for trip in batch_plan.trips:
+            grab_index = next(i for i, command in enumerate(trip.motion_plan.commands)
+                              if command.startswith("G20"))
+            grabbed_supply_eggs[offset + grab_index] = trip.supply_egg
+            offset += len(trip.motion_plan.commands)
+
+        def on_command_done(index: int):
+            if index in grabbed_supply_eggs:
+                self.supply_system.mark_used(grabbed_supply_eggs[index])
+
+        start_time = time.monotonic()
+        if not self.run_program(batch_plan.motion_plan.commands, on_command_done):
+            self.is_running = False
+            return
+        instrumentation.record(
+            "egg_cycle", (time.monotonic() - start_time) / len(batch_plan.trips))
+        self.log_event("batch_supplied", eggs=len(batch_plan.trips),
+                       duration=time.monotonic() - start_time)
+        self.reset_inspection()
+
+    def reset_inspection(self):
+        # The carton changed, every hole has to be confirmed again
+        self.tracker.reset()
+        if self.egg_predicter.prediction_cache is not None:
+            self.egg_predicter.prediction_cache.invalidate()
+
+    def run_program(self, commands: tuple[str, ...],
+                    on_command_done: Callable[[int], None] | None = None) -> bool:
+        robot_program = self.scara_robot.command_queue.submit_program(commands)
+        for i, robot_command in enumerate(robot_program):
+            try:
+                robot_status = robot_command.completed.result(
+                    timeout=HeadlessRunner.COMMAND_TIMEOUT_SECONDS)
+            except (RobotError, TimeoutError, CancelledError) as e:
+                self.scara_robot.command_queue.cancel()
+                self.log_event("robot_error", command=robot_command.command, error=str(e))
+                return False
+            self.log_event("command_done", command=robot_command.command,
+                           queued=robot_command.sent_at - robot_command.queued_at,
+                           duration=robot_command.completed_at - robot_command.sent_at,
+                           xyz=(robot_status.x, robot_status.y, robot_status.z))
+            if on_command_done is not None:
+                on_command_done(i)
+        return True
+
+    def close(self):
+        self.is_running = False
+        self.log_event("stopped", spans=instrumentation.snapshot())
+        if self.metrics_path is not None:
+            instrumentation.dump(self.metrics_path)
+        if self.preview is not None:
+            self.preview.shutdown()
+        self.drift_monitor.stop()
+        self.reference_system.locator.shutdown()
+        self.scara_robot.close()
+        self.frame_grabber.release()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Egg supplier without GUI")
+    parser.add_argument("--video-source", type=int, default=2)
+    parser.add_argument("--robot-port", default="/dev/ttyUSB0")
+    parser.add_argument("--confidence", type=float, default=0.5)
+    parser.add_argument("--preview-port", type=int, default=None,
+                        help="serve an MJPEG preview on this port")
+    parser.add_argument("--preview-fps", type=float, default=5.0)
+    parser.add_argument("--metrics", default=None,
+                        help="write latency percentiles to this .json or .csv file on exit")
+    parser.add_argument("--batch", action="store_true",
+                        help="fill every confirmed hole in a single robot program")
+    parser.add_argument("--refill", nargs="?", const="all", default=None, metavar="TRAY",
+                        help="mark every tray (or only TRAY) as full and exit")
+    args = parser.parse_args()
+
+    if args.refill is not None:
+        # A running runner picks the new state up while it waits for supply
+        SupplySystem().refill(None if args.refill == "all" else args.refill)
+        raise SystemExit
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    HeadlessRunner(video_source=args.video_source,
+                   robot_port=args.robot_port,
+                   confidence_threshold=args.confidence,
+                   preview_port=args.preview_port,
+                   preview_fps=args.preview_fps,
+                   batch_filling=args.batch,
+                   metrics_path=args.metrics).run()
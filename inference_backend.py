@@ -0,0 +1,126 @@
+from abc import ABC, abstractmethod
+from inference_sdk import InferenceHTTPClient, InferenceConfiguration
+import threading
+import cv2
+import numpy as np
+
+
+class InferenceBackend(ABC):
+    confidence_threshold: float
+
+    def __init__(self, confidence_threshold: float):
+        self.confidence_threshold = confidence_threshold
+
+    def set_confidence(self, new_confidence: float):
+        self.confidence_threshold = float(new_confidence)
+
+    # Returns detections in ROI pixel coordinates, with the same keys as
+    # the Roboflow server response: x, y, width, height, confidence, class
+    def infer(self, image: cv2.typing.MatLike) -> list[dict]:
+        return self.infer_batch([image])[0]
+
+    @abstractmethod
+    def infer_batch(self, images: list[cv2.typing.MatLike]) -> list[list[dict]]:
+        ...
+
+
+class RoboflowHTTPBackend(InferenceBackend):
+    # Crops sent in a single v1 request, v0 would make one request per crop
+    MAX_BATCH_SIZE: int = 8
+
+    inference_client: InferenceHTTPClient
+    model_id: str
+
+    def __init__(self, confidence_threshold: float, /, api_url: str, api_key: str, model_id: str):
+        super().__init__(confidence_threshold)
+        self.model_id = model_id
+        self.inference_client = InferenceHTTPClient(
+            api_url=api_url,
+            api_key=api_key
+        )
+        self.inference_client.configure(self._configuration())
+        self.inference_client.select_api_v1()
+
+    def _configuration(self) -> InferenceConfiguration:
+        return InferenceConfiguration(
+            confidence_threshold=self.confidence_threshold,
+            max_batch_size=RoboflowHTTPBackend.MAX_BATCH_SIZE)
+
+    def set_confidence(self, new_confidence: float):
+        super().set_confidence(new_confidence)
+        self.inference_client.configure(self._configuration())
+
+    def infer_batch(self, images: list[cv2.typing.MatLike]) -> list[list[dict]]:
+        results = self.inference_client.infer(images, model_id=self.model_id)
+        if isinstance(results, dict):
+            results = [results]
+        return [result["predictions"] for result in results]
+
+
+class OnnxBackend(InferenceBackend):
+    # YOLOv8 export: output is (batch, 4 + number of classes, number of anchors).
+    # Batches of more than one crop require the model exported with dynamic=True
+    net: cv2.dnn.Net
+    input_size: int
+    class_names: list[str]
+    nms_threshold: float
+
+    def __init__(self, confidence_threshold: float, /, model_path: str, class_names: list[str],
+                 input_size: int = 640, nms_threshold: float = 0.45):
+        super().__init__(confidence_threshold)
+        self.net = cv2.dnn.readNetFromONNX(model_path)
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        self.input_size = input_size
+        self.class_names = class_names
+        self.nms_threshold = nms_threshold
+        # cv2.dnn.Net is not safe to run from several threads at once
+        self._lock = threading.Lock()
+
+    def _letterbox(self, image: cv2.typing.MatLike) -> tuple[np.ndarray, float]:
+        height, width = image.shape[:2]
+        scale = self.input_size / max(height, width)
+        resized = cv2.resize(image, (round(width * scale), round(height * scale)),
+                             interpolation=cv2.INTER_LINEAR)
+        padded = np.full((self.input_size, self.input_size, 3),
+                         114, dtype=np.uint8)
+        padded[:resized.shape[0], :resized.shape[1]] = resized
+        return padded, scale
+
+    def infer_batch(self, images: list[cv2.typing.MatLike]) -> list[list[dict]]:
+        letterboxed = [self._letterbox(image) for image in images]
+        blob = cv2.dnn.blobFromImages(
+            [padded for padded, _ in letterboxed], scalefactor=1 / 255, swapRB=True)
+        with self._lock:
+            self.net.setInput(blob)
+            output = self.net.forward()
+        return [self._parse_output(output[i].T, scale)
+                for i, (_, scale) in enumerate(letterboxed)]
+
+    def _parse_output(self, output: np.ndarray, scale: float) -> list[dict]:
+        scores = output[:, 4:]
+        class_ids = scores.argmax(axis=1)
+        confidences = scores[np.arange(len(scores)), class_ids]
+        keep = confidences >= self.confidence_threshold
+        boxes = output[keep, :4] / scale
+        class_ids = class_ids[keep]
+        confidences = confidences[keep]
+
+        # NMSBoxes expects top-left corner boxes
+        corner_boxes = boxes.copy()
+        corner_boxes[:, :2] -= corner_boxes[:, 2:] / 2
+        indices = cv2.dnn.NMSBoxes(corner_boxes.tolist(), confidences.tolist(),
+                                   self.confidence_threshold, self.nms_threshold)
+
+        detections = []
+        for i in np.array(indices).flatten():
+            cx, cy, width, height = boxes[i]
+            detections.append({
+                "x": float(cx),
+                "y": float(cy),
+                "width": float(width),
+                "height": float(height),
+                "confidence": float(confidences[i]),
+                "class": self.class_names[class_ids[i]],
+            })
+        return detections
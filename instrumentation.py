@@ -0,0 +1,147 @@
+import csv
+import json
+import math
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dotenv import dotenv_values
+
+config = dotenv_values(".env")
+
+
+class LatencyHistogram:
+    # Log-spaced buckets, like an HDR histogram: constant relative error at any scale
+    RELATIVE_PRECISION: float = 0.02
+    MIN_SECONDS: float = 1e-6
+    # Samples older than two windows drop out so the percentiles follow the current behaviour
+    WINDOW_SECONDS: float = 60.0
+
+    def __init__(self, window_seconds: float = WINDOW_SECONDS):
+        self.window_seconds = window_seconds
+        self._log_base = math.log1p(LatencyHistogram.RELATIVE_PRECISION)
+        self._current = Counter()
+        self._previous = Counter()
+        self._window_started_at = time.monotonic()
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def _bucket(self, seconds: float) -> int:
+        return int(math.log(max(seconds, LatencyHistogram.MIN_SECONDS) /
+                            LatencyHistogram.MIN_SECONDS) / self._log_base)
+
+    def _bucket_value(self, bucket: int) -> float:
+        # Middle of the bucket
+        return LatencyHistogram.MIN_SECONDS * math.exp((bucket + 0.5) * self._log_base)
+
+    def _rotate(self):
+        now = time.monotonic()
+        if now - self._window_started_at < self.window_seconds:
+            return
+        # Two windows without samples leave nothing of the old ones
+        self._previous = self._current \
+            if now - self._window_started_at < 2 * self.window_seconds else Counter()
+        self._current = Counter()
+        self._window_started_at = now
+
+    def record(self, seconds: float):
+        self._rotate()
+        self._current[self._bucket(seconds)] += 1
+        self.count += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    def percentiles(self, quantiles: tuple[float, ...]) -> list[float | None]:
+        self._rotate()
+        buckets = self._current + self._previous
+        total = sum(buckets.values())
+        if total == 0:
+            return [None] * len(quantiles)
+        sorted_buckets = sorted(buckets.items())
+        values = []
+        for quantile in quantiles:
+            rank = quantile * total
+            seen = 0
+            for bucket, count in sorted_buckets:
+                seen += count
+                if seen >= rank:
+                    values.append(self._bucket_value(bucket))
+                    break
+        return values
+
+
+class Instrumentation:
+    QUANTILES: tuple[float, ...] = (0.5, 0.95, 0.99)
+    METRICS_FILE: str = config.get("METRICS_FILE", "metrics.json")
+
+    histograms: dict[str, LatencyHistogram]
+
+    def __init__(self):
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = LatencyHistogram()
+            histogram.record(seconds)
+
+    @contextmanager
+    def span(self, name: str):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start_time)
+
+    def snapshot(self) -> dict[str, dict]:
+        with self._lock:
+            snapshot = {}
+            for name, histogram in sorted(self.histograms.items()):
+                p50, p95, p99 = histogram.percentiles(Instrumentation.QUANTILES)
+                snapshot[name] = {
+                    "count": histogram.count,
+                    "mean": histogram.total_seconds / histogram.count,
+                    "p50": p50,
+                    "p95": p95,
+                    "p99": p99,
+                    "max": histogram.max_seconds,
+                }
+            return snapshot
+
+    def dump(self, path: str = METRICS_FILE):
+        # CSV or JSON depending on the extension, times in seconds
+        snapshot = self.snapshot()
+        if path.endswith(".csv"):
+            with open(path, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(("span", "count", "mean", "p50", "p95", "p99", "max"))
+                for name, stats in snapshot.items():
+                    writer.writerow((name, stats["count"], stats["mean"], stats["p50"],
+                                     stats["p95"], stats["p99"], stats["max"]))
+        else:
+            with open(path, "w") as f:
+                json.dump({"time": time.time(), "spans": snapshot}, f, indent=2)
+
+    def format_table(self) -> str:
+        lines = [f"{'span':<24}{'n':>7}{'p50':>9}{'p95':>9}{'p99':>9}"]
+        for name, stats in self.snapshot().items():
+            lines.append(f"{name:<24}{stats['count']:>7}" + "".join(
+                f"{stats[key] * 1000:>7.1f}ms" if stats[key] is not None else f"{'-':>9}"
+                for key in ("p50", "p95", "p99")))
+        return "\n".join(lines)
+
+
+instrumentation = Instrumentation()
+
+
+if __name__ == "__main__":
+    import random
+    for _ in range(10000):
+        instrumentation.record("uniform_10ms", random.uniform(0, 0.02))
+        instrumentation.record("exponential_1ms", random.expovariate(1000))
+    with instrumentation.span("sleep_50ms"):
+        time.sleep(0.05)
+    print(instrumentation.format_table())
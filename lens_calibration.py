@@ -0,0 +1,139 @@
+import cv2
+import numpy as np
+from dotenv import dotenv_values
+from roi import ROI
+from calibration_store import calibration_store
+
+config = dotenv_values(".env")
+
+
+class LensCalibration:
+    # Inner corners of the printed checkerboard
+    CHECKERBOARD: tuple[int, int] = tuple(
+        int(v) for v in config.get("CHECKERBOARD_SIZE", "9,6").split(","))
+    SQUARE_MM: float = float(config.get("CHECKERBOARD_SQUARE_MM", 20))
+    MIN_VIEWS: int = 10
+
+    camera_matrix: np.ndarray
+    dist_coeffs: np.ndarray
+    image_size: tuple[int, int]
+    rms: float
+
+    def __init__(self, camera_matrix: np.ndarray, dist_coeffs: np.ndarray,
+                 image_size: tuple[int, int], rms: float):
+        self.camera_matrix = np.asarray(camera_matrix, dtype=np.float64)
+        self.dist_coeffs = np.asarray(dist_coeffs, dtype=np.float64)
+        self.image_size = tuple(image_size)
+        self.rms = rms
+        self._maps = None
+        self._roi_maps = {}
+
+    @classmethod
+    def load(cls) -> "LensCalibration | None":
+        lens = calibration_store.get_lens()
+        if lens is None:
+            return None
+        return cls(lens["camera_matrix"], lens["dist_coeffs"], lens["image_size"], lens["rms"])
+
+    def save(self):
+        calibration_store.set_lens(self.camera_matrix.tolist(), self.dist_coeffs.tolist(),
+                                   self.image_size, self.rms)
+
+    @staticmethod
+    def find_corners(frame: cv2.typing.MatLike) -> np.ndarray | None:
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        is_found, corners = cv2.findChessboardCorners(
+            gray, LensCalibration.CHECKERBOARD,
+            flags=cv2.CALIB_CB_ADAPTIVE_THRESH + cv2.CALIB_CB_NORMALIZE_IMAGE)
+        if not is_found:
+            return None
+        return cv2.cornerSubPix(gray, corners, (11, 11), (-1, -1),
+                                (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001))
+
+    @classmethod
+    def calibrate(cls, views: list[np.ndarray], image_size: tuple[int, int]) -> "LensCalibration":
+        if len(views) < LensCalibration.MIN_VIEWS:
+            raise ValueError(
+                f"{len(views)} checkerboard views, at least {LensCalibration.MIN_VIEWS} needed")
+        columns, rows = LensCalibration.CHECKERBOARD
+        board = np.zeros((columns * rows, 3), dtype=np.float32)
+        board[:, :2] = np.mgrid[0:columns, 0:rows].T.reshape(-1, 2) * LensCalibration.SQUARE_MM
+        rms, camera_matrix, dist_coeffs, _, _ = cv2.calibrateCamera(
+            [board] * len(views), views, image_size, None, None)
+        return cls(camera_matrix, dist_coeffs, image_size, rms)
+
+    def undistort_points(self, points: np.ndarray) -> np.ndarray:
+        # Same camera matrix as the remap tables, so both give the same pixels
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 1, 2)
+        if len(points) == 0:
+            return np.empty((0, 2))
+        return cv2.undistortPoints(points, self.camera_matrix, self.dist_coeffs,
+                                   P=self.camera_matrix).reshape(-1, 2)
+
+    def distort_points(self, points: np.ndarray) -> np.ndarray:
+        # Undistorted pixels back to the raw frame, the inverse of undistort_points
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        if len(points) == 0:
+            return np.empty((0, 2))
+        rays = cv2.convertPointsToHomogeneous(points).reshape(-1, 3) @ \
+            np.linalg.inv(self.camera_matrix).T
+        distorted, _ = cv2.projectPoints(rays, np.zeros(3), np.zeros(3),
+                                         self.camera_matrix, self.dist_coeffs)
+        return distorted.reshape(-1, 2)
+
+    def roi_maps(self, roi: ROI) -> tuple[np.ndarray, np.ndarray]:
+        # Built once for the whole image, each ROI keeps its own slice
+        key = (roi.x, roi.y, roi.width, roi.height)
+        maps = self._roi_maps.get(key)
+        if maps is None:
+            if self._maps is None:
+                self._maps = cv2.initUndistortRectifyMap(
+                    self.camera_matrix, self.dist_coeffs, None, self.camera_matrix,
+                    self.image_size, cv2.CV_16SC2)
+            maps = tuple(np.ascontiguousarray(m[roi.y:roi.y + roi.height, roi.x:roi.x + roi.width])
+                         for m in self._maps)
+            self._roi_maps[key] = maps
+        return maps
+
+    def undistort_roi(self, frame: cv2.typing.MatLike, roi: ROI) -> cv2.typing.MatLike:
+        # Only the ROI's pixels are remapped, at the same coordinates as the ROI crop
+        if tuple(frame.shape[1::-1]) != self.image_size:
+            # The camera matrix only holds for the resolution it was calibrated at
+            raise ValueError(f"Frame is {frame.shape[1]}x{frame.shape[0]}, the lens was calibrated "
+                             f"at {self.image_size[0]}x{self.image_size[1]}")
+        map_1, map_2 = self.roi_maps(roi)
+        return cv2.remap(frame, map_1, map_2, cv2.INTER_LINEAR)
+
+
+if __name__ == "__main__":
+    import time
+    from frame_grabber import FrameGrabber
+    frame_grabber = FrameGrabber(2)
+
+    # Move the checkerboard around the belt, a view is taken every second it's seen
+    views = []
+    last_view_time = 0.0
+    sequence = 0
+    while True:
+        sequence, _, frame = frame_grabber.read_newer(sequence)
+        if frame is None:
+            print("Error reading image from camera")
+            continue
+        corners = LensCalibration.find_corners(frame)
+        if corners is not None:
+            cv2.drawChessboardCorners(frame, LensCalibration.CHECKERBOARD, corners, True)
+            if time.monotonic() - last_view_time > 1.0:
+                views.append(corners)
+                last_view_time = time.monotonic()
+                print(f"view {len(views)}/{LensCalibration.MIN_VIEWS}")
+        cv2.imshow("Lens calibration", frame)
+        if cv2.waitKey(1) & 0xFF == ord('q') or len(views) >= 2 * LensCalibration.MIN_VIEWS:
+            break
+
+    lens = LensCalibration.calibrate(views, (frame.shape[1], frame.shape[0]))
+    print(f"rms reprojection error: {lens.rms:.3f} px")
+    print(lens.camera_matrix)
+    print(lens.dist_coeffs)
+    lens.save()
+    frame_grabber.release()
+    cv2.destroyAllWindows()
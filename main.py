@@ -1,3 +1,7 @@
+from dotenv import dotenv_values
 from egg_supplier_cv import EggSupplierCV
 
-EggSupplierCV(video_source=2, robot_port="/dev/ttyUSB0").run()
\ No newline at end of file
+config = dotenv_values(".env")
+
+EggSupplierCV(video_source=2, belt_port=config.get("BELT_PORT", ""),
+              robot_port="/dev/ttyUSB0").run()
\ No newline at end of file
@@ -0,0 +1,82 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
+import cv2
+
+
+class MJPEGServer:
+    BOUNDARY: str = "frame"
+
+    fps: float
+    jpeg_quality: int
+    server: ThreadingHTTPServer
+
+    def __init__(self, port: int, /, fps: float = 5.0, jpeg_quality: int = 70, scale: float = 0.5):
+        self.fps = fps
+        self.jpeg_quality = jpeg_quality
+        self.scale = scale
+        self._jpeg = None
+        self._last_update = 0.0
+        self._condition = threading.Condition()
+
+        mjpeg_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header(
+                    "Content-Type", f"multipart/x-mixed-replace; boundary={MJPEGServer.BOUNDARY}")
+                self.end_headers()
+                jpeg = None
+                try:
+                    while True:
+                        jpeg = mjpeg_server.wait_for_jpeg(jpeg)
+                        self.wfile.write(
+                            f"--{MJPEGServer.BOUNDARY}\r\n".encode())
+                        self.wfile.write(b"Content-Type: image/jpeg\r\n")
+                        self.wfile.write(
+                            f"Content-Length: {len(jpeg)}\r\n\r\n".encode())
+                        self.wfile.write(jpeg)
+                        self.wfile.write(b"\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("", port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def wants_frame(self) -> bool:
+        # 0 or less encodes every frame
+        if self.fps <= 0:
+            return True
+        return time.monotonic() - self._last_update >= 1 / self.fps
+
+    def update(self, frame: cv2.typing.MatLike):
+        # Encoding is skipped entirely between preview frames
+        if not self.wants_frame():
+            return
+        self._last_update = time.monotonic()
+        if self.scale != 1.0:
+            frame = cv2.resize(frame, None, fx=self.scale, fy=self.scale,
+                               interpolation=cv2.INTER_AREA)
+        ret, jpeg = cv2.imencode(
+            ".jpg", frame, (cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality))
+        if not ret:
+            return
+        with self._condition:
+            self._jpeg = jpeg.tobytes()
+            self._condition.notify_all()
+
+    def wait_for_jpeg(self, previous_jpeg: bytes | None) -> bytes:
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._jpeg is not None and self._jpeg is not previous_jpeg)
+            return self._jpeg
+
+    def shutdown(self):
+        self.server.shutdown()
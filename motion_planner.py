@@ -0,0 +1,235 @@
+import math
+import re
+from dotenv import dotenv_values
+from scara_robot import ScaraRobot, RobotStatus
+from supply_egg import SupplySystem, SupplyEgg
+
+config = dotenv_values(".env")
+
+
+class JointLimits:
+    max_speed: float
+    acceleration: float
+
+    def __init__(self, max_speed: float, acceleration: float):
+        self.max_speed = max_speed
+        self.acceleration = acceleration
+
+    def move_time(self, distance: float) -> float:
+        # Trapezoidal velocity profile, triangular if max speed isn't reached
+        distance = abs(distance)
+        if distance == 0:
+            return 0.0
+        acceleration_distance = self.max_speed ** 2 / self.acceleration
+        if distance < acceleration_distance:
+            return 2 * math.sqrt(distance / self.acceleration)
+        return 2 * self.max_speed / self.acceleration + \
+            (distance - acceleration_distance) / self.max_speed
+
+
+class ScaraKinematics:
+    # Joints are [J1, J2, J3, J4]: J1 shoulder and J3 elbow in degrees,
+    # J2 is the Z axis in mm and J4 the wrist in degrees.
+    # Only used to estimate move times, XY moves are solved by the firmware (G0)
+    L1: float = float(config.get("SCARA_L1_MM", 228))
+    L2: float = float(config.get("SCARA_L2_MM", 136.5))
+
+    def __init__(self, l1: float = L1, l2: float = L2):
+        self.l1 = l1
+        self.l2 = l2
+
+    def forward(self, j1: float, j3: float) -> tuple[float, float]:
+        j1, j3 = math.radians(j1), math.radians(j3)
+        x = self.l1 * math.cos(j1) + self.l2 * math.cos(j1 + j3)
+        y = self.l1 * math.sin(j1) + self.l2 * math.sin(j1 + j3)
+        return x, y
+
+    def inverse(self, x: float, y: float) -> tuple[float, float] | None:
+        cos_j3 = (x ** 2 + y ** 2 - self.l1 ** 2 - self.l2 ** 2) / \
+            (2 * self.l1 * self.l2)
+        if abs(cos_j3) > 1:
+            return None
+        j3 = math.acos(cos_j3)
+        j1 = math.atan2(y, x) - math.atan2(self.l2 * math.sin(j3),
+                                           self.l1 + self.l2 * math.cos(j3))
+        return math.degrees(j1), math.degrees(j3)
+
+    def error_mm(self, robot_state: RobotStatus) -> float:
+        # Distance between the X/Y the firmware reports and this model's
+        x, y = self.forward(robot_state.j1, robot_state.j3)
+        return math.hypot(x - robot_state.x, y - robot_state.y)
+
+
+DEFAULT_JOINT_LIMITS = (
+    JointLimits(max_speed=90, acceleration=180),
+    JointLimits(max_speed=100, acceleration=300),
+    JointLimits(max_speed=90, acceleration=180),
+    JointLimits(max_speed=180, acceleration=720),
+)
+
+
+class MotionPlan:
+    commands: tuple[str, ...]
+    estimated_time_seconds: float
+    final_joints: list[float]
+    command_end_times: tuple[float, ...]
+
+    def __init__(self, commands: tuple[str, ...], estimated_time_seconds: float, final_joints: list[float],
+                 command_end_times: tuple[float, ...] = ()):
+        self.commands = commands
+        self.estimated_time_seconds = estimated_time_seconds
+        self.final_joints = final_joints
+        self.command_end_times = command_end_times
+
+    def time_until(self, command_prefix: str) -> float | None:
+        # Seconds from the program start until the first matching command starts
+        for i, command in enumerate(self.commands):
+            if command.startswith(command_prefix):
+                return self.command_end_times[i - 1] if i > 0 else 0.0
+        return None
+
+
+class MotionPlanner:
+    HOME_JOINTS: tuple[float, float, float, float] = (
+        0.0, SupplySystem.SAFE_Z_POSITION_MM, 0.0, 0.0)
+    GRIPPER_TIME_SECONDS: float = 0.3
+    # Per-command overhead: serial round trip and firmware parsing
+    COMMAND_OVERHEAD_SECONDS: float = 0.02
+    # Above this the link lengths or joint conventions don't match the firmware
+    MAX_KINEMATICS_ERROR_MM: float = 5.0
+
+    COMMAND_PATTERN = re.compile(r"^G(\d+)((?:\s+[A-Z]-?[\d.]+)*)\s*$")
+    PARAMETER_PATTERN = re.compile(r"([A-Z])(-?[\d.]+)")
+
+    scara_robot: ScaraRobot
+    kinematics: ScaraKinematics
+    joint_limits: tuple[JointLimits, ...]
+
+    def __init__(self, scara_robot: ScaraRobot, /,
+                 kinematics: ScaraKinematics | None = None,
+                 joint_limits: tuple[JointLimits, ...] = DEFAULT_JOINT_LIMITS,
+                 use_approach_stop: bool = True):
+        self.scara_robot = scara_robot
+        self.kinematics = kinematics if kinematics is not None else ScaraKinematics()
+        self.joint_limits = joint_limits
+        self.use_approach_stop = use_approach_stop
+
+    def move_time(self, start_joints: list[float], target_joints: list[float]) -> float:
+        # Joints move simultaneously, the slowest one sets the time
+        return max(limits.move_time(target - start)
+                   for limits, target, start in zip(self.joint_limits, target_joints, start_joints))
+
+    def apply_command(self, command: str, joints: list[float]) -> tuple[list[float], float]:
+        match = MotionPlanner.COMMAND_PATTERN.match(command.strip().upper())
+        if match is None:
+            raise ValueError(f"Unknown command: {command}")
+        code = int(match.group(1))
+        parameters = {name: float(value) for name, value in
+                      MotionPlanner.PARAMETER_PATTERN.findall(match.group(2))}
+
+        if code == 0:
+            x, y = self.kinematics.forward(joints[0], joints[2])
+            solution = self.kinematics.inverse(
+                parameters.get("X", x), parameters.get("Y", y))
+            if solution is None:
+                raise ValueError(f"Unreachable position: {command}")
+            target_joints = [solution[0], parameters.get("Z", joints[1]),
+                             solution[1], joints[3]]
+        elif code == 10:
+            target_joints = [0.0, 0.0, 0.0, 0.0]
+        elif code in (11, 12):
+            target_joints = [parameters.get("H", joints[0]),
+                             parameters.get("J", joints[1]),
+                             parameters.get("K", joints[2]),
+                             parameters.get("L", joints[3])]
+            if code == 12:
+                return target_joints, 0.0
+        elif code in (20, 21):
+            return joints, MotionPlanner.GRIPPER_TIME_SECONDS
+        else:
+            raise ValueError(f"Unknown command: {command}")
+        return target_joints, self.move_time(joints, target_joints)
+
+    def estimate(self, commands: tuple[str, ...] | list[str],
+                 start_joints: tuple[float, ...] | list[float] = HOME_JOINTS) -> MotionPlan:
+        joints = list(start_joints)
+        total_time = 0.0
+        command_end_times = []
+        for command in commands:
+            joints, command_time = self.apply_command(command, joints)
+            total_time += command_time + MotionPlanner.COMMAND_OVERHEAD_SECONDS
+            command_end_times.append(total_time)
+        return MotionPlan(tuple(commands), total_time, joints, tuple(command_end_times))
+
+    def current_joints(self) -> list[float] | None:
+        # None until the robot reports its state, the Z height can't be assumed
+        robot_state = self.scara_robot.state
+        if robot_state is None:
+            return None
+        if self.kinematics.error_mm(robot_state) > MotionPlanner.MAX_KINEMATICS_ERROR_MM:
+            print(f"Kinematics model is {self.kinematics.error_mm(robot_state):.1f} mm off the "
+                  "robot's reported position, time estimates are unreliable")
+        return [robot_state.j1, robot_state.j2, robot_state.j3, robot_state.j4]
+
+    def plan_pick_and_place(self, supply_egg: SupplyEgg, target_x: float, target_y: float, /,
+                            start_joints: tuple[float, ...] | list[float] | None = None,
+                            return_home: bool = True) -> MotionPlan:
+        commands = []
+        # J4 turns to the grab angle together with the lift. The lift is only
+        # skipped when the arm is known to be at safe Z already
+        if start_joints is None or start_joints[1] != SupplySystem.SAFE_Z_POSITION_MM:
+            commands.append(self.scara_robot.go_to_articular_coordinate(
+                j2=SupplySystem.SAFE_Z_POSITION_MM, j4=supply_egg.grab_j4_angle_degrees))
+        else:
+            commands.append(self.scara_robot.go_to_articular_coordinate(
+                j4=supply_egg.grab_j4_angle_degrees))
+
+        # XY transits stay on the firmware's own inverse kinematics
+        commands.append(self.scara_robot.go_to_cartesian_coordinate(
+            x=round(supply_egg.grab_x_position_mm, 2), y=round(supply_egg.grab_y_position_mm, 2)))
+        if self.use_approach_stop:
+            commands.append(self.scara_robot.go_to_articular_coordinate(
+                j2=SupplySystem.APPROACH_Z_POSITION_MM))
+        commands.append(self.scara_robot.go_to_articular_coordinate(
+            j2=SupplySystem.GRAB_Z_POSITION_MM))
+        commands.append(self.scara_robot.act_tool(
+            value=SupplySystem.GRAB_GRIPPER_VALUE))
+        commands.append(self.scara_robot.go_to_articular_coordinate(
+            j2=SupplySystem.SAFE_Z_POSITION_MM))
+
+        commands.append(self.scara_robot.go_to_cartesian_coordinate(
+            x=round(float(target_x), 2), y=round(float(target_y), 2)))
+        commands.append(self.scara_robot.go_to_articular_coordinate(
+            j2=SupplySystem.RELEASE_Z_POSITION_MM))
+        commands.append(self.scara_robot.release_tool())
+        commands.append(self.scara_robot.go_to_articular_coordinate(
+            j2=SupplySystem.SAFE_Z_POSITION_MM))
+
+        # Another hole is queued: go straight there instead of passing by home
+        if return_home:
+            commands.append(self.scara_robot.go_to_articular_coordinate(
+                j1=0, j3=0))
+
+        # An unknown start is only assumed at home for the time estimate
+        return self.estimate(commands, start_joints if start_joints is not None else MotionPlanner.HOME_JOINTS)
+
+
+if __name__ == "__main__":
+    class GCodeBuilder(ScaraRobot):
+        # Only builds G-code strings, no serial port needed
+        def __init__(self):
+            self.state = None
+
+    scara_robot = GCodeBuilder()
+    motion_planner = MotionPlanner(scara_robot)
+    supply_system = SupplySystem(state_file=None)
+
+    for supply_egg in supply_system.supply_eggs:
+        legacy_plan = motion_planner.estimate(SupplySystem.pick_and_place_program(
+            scara_robot, supply_egg, 0, 250))
+        plan = motion_planner.plan_pick_and_place(supply_egg, 0, 250)
+        queued_plan = motion_planner.plan_pick_and_place(
+            supply_egg, 0, 250, return_home=False)
+        print(f"legacy: {len(legacy_plan.commands)} commands {legacy_plan.estimated_time_seconds:.2f} s | "
+              f"planned: {len(plan.commands)} commands {plan.estimated_time_seconds:.2f} s | "
+              f"without home return: {queued_plan.estimated_time_seconds:.2f} s")
@@ -0,0 +1,46 @@
+import cv2
+import numpy as np
+from typing import Protocol
+
+
+class Drawable(Protocol):
+    def draw(self, frame: cv2.typing.MatLike): ...
+
+
+class OverlayLayer:
+    # ROIs and reference circles only move on recalibration, so they are drawn
+    # once into an RGBA layer and pasted onto a display copy of every frame.
+    # The frames given to inference are never drawn on.
+    drawables: list[Drawable]
+    mask: np.ndarray | None
+
+    def __init__(self, drawables: list[Drawable]):
+        self.drawables = drawables
+        self.mask = None
+        self._display = None
+        self._pixels = None
+        self._colors = None
+
+    def invalidate(self):
+        self.mask = None
+
+    def _render(self, shape: tuple[int, ...]):
+        layer = np.zeros(shape, dtype=np.uint8)
+        for drawable in self.drawables:
+            drawable.draw(layer)
+        alpha = layer.any(axis=2)
+        self.mask = np.dstack((cv2.cvtColor(layer, cv2.COLOR_BGR2RGB),
+                               alpha.astype(np.uint8) * 255))
+        # Only a few thousand pixels are drawn, pasting them beats blending the frame
+        self._pixels = np.nonzero(alpha)
+        self._colors = layer[self._pixels]
+
+    def compose(self, frame: cv2.typing.MatLike) -> np.ndarray:
+        if self._display is None or self._display.shape != frame.shape:
+            self._display = np.empty_like(frame)
+            self.mask = None
+        if self.mask is None:
+            self._render(frame.shape)
+        np.copyto(self._display, frame)
+        self._display[self._pixels] = self._colors
+        return self._display
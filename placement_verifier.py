@@ -0,0 +1,85 @@
+import cv2
+import numpy as np
+from tracker import Track
+from lens_calibration import LensCalibration
+
+
+class PlacementVerifier:
+    # Only the centre of the box, the carton edges look the same filled or empty
+    CROP_SCALE: float = 0.6
+    LEARNING_RATE: float = 0.1
+    # Samples of each class needed before the references are trusted
+    MIN_SAMPLES: int = 5
+
+    references: dict[str, np.ndarray]
+    samples: dict[str, int]
+
+    def __init__(self, crop_scale: float = CROP_SCALE):
+        self.crop_scale = crop_scale
+        self.references = {}
+        self.samples = {"egg": 0, "hole": 0}
+
+    def crop(self, frame: cv2.typing.MatLike, cx: float, cy: float,
+             width: float, height: float) -> cv2.typing.MatLike | None:
+        half_width = max(1, int(width * self.crop_scale / 2))
+        half_height = max(1, int(height * self.crop_scale / 2))
+        x0, y0 = max(0, int(cx) - half_width), max(0, int(cy) - half_height)
+        x1 = min(frame.shape[1], int(cx) + half_width)
+        y1 = min(frame.shape[0], int(cy) + half_height)
+        if x1 <= x0 or y1 <= y0:
+            return None
+        return frame[y0:y1, x0:x1]
+
+    @staticmethod
+    def features(crop: cv2.typing.MatLike) -> np.ndarray:
+        # Eggs are bright and uniform, holes dark with the carton's shadows
+        lab = cv2.cvtColor(crop, cv2.COLOR_BGR2LAB)
+        mean, std = cv2.meanStdDev(lab)
+        return np.array((mean[0, 0], mean[1, 0], mean[2, 0], std[0, 0]))
+
+    @property
+    def is_ready(self) -> bool:
+        return all(samples >= PlacementVerifier.MIN_SAMPLES
+                   for samples in self.samples.values())
+
+    @staticmethod
+    def frame_positions(positions: np.ndarray, lens: LensCalibration | None) -> np.ndarray:
+        # Tracks are in undistorted pixels, the frame they are cropped from is raw
+        if lens is None:
+            return np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+        return lens.distort_points(positions)
+
+    def learn(self, frame: cv2.typing.MatLike, tracks: list[Track], timestamp: float | None = None,
+              lens: LensCalibration | None = None):
+        if not tracks:
+            return
+        positions = PlacementVerifier.frame_positions(
+            [track.predicted_position(timestamp) for track in tracks], lens)
+        for track, (cx, cy) in zip(tracks, positions):
+            crop = self.crop(frame, cx, cy, track.width, track.height)
+            if crop is None:
+                continue
+            features = PlacementVerifier.features(crop)
+            reference = self.references.get(track.class_label)
+            if reference is None:
+                self.references[track.class_label] = features
+            else:
+                reference += PlacementVerifier.LEARNING_RATE * \
+                    (features - reference)
+            self.samples[track.class_label] += 1
+
+    def filled_score(self, frame: cv2.typing.MatLike, cx: float, cy: float,
+                     width: float, height: float, lens: LensCalibration | None = None) -> float | None:
+        # 1 looks like an egg, 0 like a hole, None if there's nothing to compare with yet
+        if not self.is_ready:
+            return None
+        cx, cy = PlacementVerifier.frame_positions(((cx, cy),), lens)[0]
+        crop = self.crop(frame, cx, cy, width, height)
+        if crop is None:
+            return None
+        features = PlacementVerifier.features(crop)
+        egg_distance = np.linalg.norm(features - self.references["egg"])
+        hole_distance = np.linalg.norm(features - self.references["hole"])
+        if egg_distance + hole_distance == 0:
+            return None
+        return float(hole_distance / (egg_distance + hole_distance))
@@ -1,8 +1,16 @@
-from inference_sdk import InferenceHTTPClient, InferenceConfiguration
 from dotenv import dotenv_values
+from concurrent.futures import ThreadPoolExecutor, Future
+import threading
+import time
 import cv2
+import numpy as np
 from roi import ROI
-from prediction import Prediction
+from prediction import PredictionBatch
+from frame_grabber import FrameGrabber
+from inference_backend import InferenceBackend, RoboflowHTTPBackend, OnnxBackend
+from prediction_cache import PredictionCache
+from lens_calibration import LensCalibration
+from instrumentation import instrumentation
 
 config = dotenv_values(".env")
 
@@ -10,61 +18,177 @@ config = dotenv_values(".env")
 class EggPredicter:
     PROJECT_ID: str = config["ROBOFLOW_PROJECT_ID"]
     MODEL_VERSION: str = config["ROBOFLOW_MODEL_VERSION"]
-    inference_client: InferenceHTTPClient
+    BACKEND: str = config.get("PREDICTER_BACKEND", "http")
+    backend: InferenceBackend
     eggs_roi: ROI
+    # Inferred together with the eggs ROI when the supply trays are watched
+    supply_roi: ROI | None
+    supply_predictions: PredictionBatch | None
+    crops_per_second: float
+    prediction_cache: PredictionCache | None
+    lens: LensCalibration | None
 
-    def __init__(self, confidence_threshold: float, capture: cv2.VideoCapture):
+    def __init__(self, confidence_threshold: float, frame_grabber: FrameGrabber, /, use_cache: bool = True,
+                 interactive: bool = True):
 
-        self.inference_client = InferenceHTTPClient(
-            api_url="http://localhost:8080",
-            api_key=config["ROBOFLOW_API_KEY"]
-        )
-
-        self.inference_client.configure(InferenceConfiguration(
-            confidence_threshold=confidence_threshold))
-        self.inference_client.select_api_v0()
+        self.backend = EggPredicter.create_backend(confidence_threshold)
 
         self.eggs_roi = ROI("eggs")
-        self.eggs_roi.load(capture)
-
-    def calibrate_roi(self, capture: cv2.VideoCapture):
-        self.eggs_roi.save(capture)
+        self.eggs_roi.load(frame_grabber, interactive=interactive)
+        self.supply_roi = None
+        self.supply_predictions = None
+        self.crops_per_second = 0.0
+        self.prediction_cache = PredictionCache() if use_cache else None
+        self.lens = LensCalibration.load()
+
+    def calibrate_roi(self, frame_grabber: FrameGrabber):
+        self.eggs_roi.save(frame_grabber)
+        if self.prediction_cache is not None:
+            self.prediction_cache.invalidate()
+
+    @staticmethod
+    def create_backend(confidence_threshold: float) -> InferenceBackend:
+        if EggPredicter.BACKEND == "onnx":
+            return OnnxBackend(
+                confidence_threshold,
+                model_path=config.get("ONNX_MODEL_PATH", "model.onnx"),
+                class_names=config.get(
+                    "ONNX_CLASS_NAMES", "eggs,hole").split(","),
+                input_size=int(config.get("ONNX_INPUT_SIZE", 640)))
+        if EggPredicter.BACKEND == "http":
+            return RoboflowHTTPBackend(
+                confidence_threshold,
+                api_url=config.get("ROBOFLOW_API_URL",
+                                   "http://localhost:8080"),
+                api_key=config["ROBOFLOW_API_KEY"],
+                model_id=f"{EggPredicter.PROJECT_ID}/{EggPredicter.MODEL_VERSION}")
+        raise ValueError(
+            f"Unknown PREDICTER_BACKEND: {EggPredicter.BACKEND}")
 
     def set_confidence(self, new_confidence: float):
-        self.inference_client.configure(InferenceConfiguration(
-            confidence_threshold=new_confidence))
-
-    def predict(self, frame: cv2.typing.MatLike) -> list[Prediction]:
-        eggs_roi_frame = self.eggs_roi.get_frame(frame)
-        self.eggs_roi.draw(frame)
-        results = self.inference_client.infer(
-            eggs_roi_frame,
-            model_id=f"{EggPredicter.PROJECT_ID}/{EggPredicter.MODEL_VERSION}")["predictions"]
-        predictions = []
-        for prediction in results:
-            cx = int(prediction["x"]) + self.eggs_roi.x
-            cy = int(prediction["y"]) + self.eggs_roi.y
-            width = int(prediction["width"])
-            height = int(prediction["height"])
-            confidence = prediction["confidence"]
-            label = prediction["class"]
-
-            prediction = Prediction(cx, cy, width, height, confidence, label)
-            predictions.append(prediction)
-            prediction.draw(frame)
-
+        self.backend.set_confidence(new_confidence)
+        if self.prediction_cache is not None:
+            self.prediction_cache.invalidate()
+
+    def predict(self, frame: cv2.typing.MatLike, use_cache: bool = True) -> PredictionBatch:
+        # One request for the carton and the supply trays, the trays' result
+        # is left in supply_predictions
+        rois = [self.eggs_roi] if self.supply_roi is None else [self.eggs_roi, self.supply_roi]
+        predictions = None
+        use_cache = use_cache and self.prediction_cache is not None
+        if use_cache:
+            # A hit needs both ROIs unchanged
+            signature = np.concatenate([PredictionCache.compute_signature(roi.get_frame(frame))
+                                        for roi in rois])
+            predictions = self.prediction_cache.get(signature)
+        if predictions is None:
+            results = self.predict_rois(frame, rois)
+            predictions = results[0]
+            if self.supply_roi is not None:
+                self.supply_predictions = results[1]
+            if use_cache:
+                self.prediction_cache.store(signature, predictions)
         return predictions
 
+    def predict_rois(self, frame: cv2.typing.MatLike, rois: list[ROI]) -> list[PredictionBatch]:
+        with instrumentation.span("roi_crop"):
+            # Only the ROIs are undistorted, with the cached remap tables
+            crops = [self.lens.undistort_roi(frame, roi) if self.lens is not None else roi.get_frame(frame)
+                     for roi in rois]
+        start_time = time.perf_counter()
+        results = self.backend.infer_batch(crops)
+        elapsed_time = time.perf_counter() - start_time
+        instrumentation.record("inference", elapsed_time)
+        if elapsed_time > 0:
+            # Smoothed so a single slow request doesn't hide the trend
+            self.crops_per_second = 0.9 * self.crops_per_second + \
+                0.1 * len(rois) / elapsed_time
+
+        return [PredictionBatch.from_results(roi_results, roi.x, roi.y)
+                for roi, roi_results in zip(rois, results)]
+
+
+class PredictionPipeline:
+    MAX_CONCURRENCY: int = 8
+
+    egg_predicter: EggPredicter
+    executor: ThreadPoolExecutor
+    concurrency: int
+    in_flight: int
+    latest_sequence: int
+    latest_timestamp: float | None
+    latest_predictions: PredictionBatch
+
+    def __init__(self, egg_predicter: EggPredicter, concurrency: int = 2):
+        self.egg_predicter = egg_predicter
+        self.executor = ThreadPoolExecutor(
+            max_workers=PredictionPipeline.MAX_CONCURRENCY,
+            thread_name_prefix="predicter")
+        self.concurrency = 1
+        self.set_concurrency(concurrency)
+        self.in_flight = 0
+        self.latest_sequence = 0
+        self.latest_timestamp = None
+        self.latest_predictions = PredictionBatch()
+        self._lock = threading.Lock()
+
+    def set_concurrency(self, concurrency: int):
+        self.concurrency = max(
+            1, min(int(concurrency), PredictionPipeline.MAX_CONCURRENCY))
+
+    def submit(self, sequence: int, frame: cv2.typing.MatLike, timestamp: float | None = None,
+               use_cache: bool = True) -> bool:
+        # Drop the frame instead of queueing when every slot is busy
+        with self._lock:
+            if self.in_flight >= self.concurrency or sequence <= self.latest_sequence:
+                return False
+            self.in_flight += 1
+        # Frames are only read from here on, overlays go on a display copy
+        future = self.executor.submit(self._predict, frame, use_cache)
+        future.add_done_callback(
+            lambda f: self._on_prediction_done(sequence, timestamp, f))
+        return True
+
+    def _predict(self, frame: cv2.typing.MatLike, use_cache: bool) -> PredictionBatch:
+        # Whole request including the cache lookup
+        with instrumentation.span("predict"):
+            return self.egg_predicter.predict(frame, use_cache)
+
+    def _on_prediction_done(self, sequence: int, timestamp: float | None, future: Future):
+        with self._lock:
+            self.in_flight -= 1
+            try:
+                predictions = future.result()
+            except Exception as e:
+                print(e)
+                return
+            # Requests may complete out of order, never go back in time
+            if sequence > self.latest_sequence:
+                self.latest_sequence = sequence
+                self.latest_timestamp = timestamp
+                self.latest_predictions = predictions
+
+    def latest(self) -> tuple[int, PredictionBatch]:
+        with self._lock:
+            return self.latest_sequence, self.latest_predictions
+
+    def latest_timestamped(self) -> tuple[int, float | None, PredictionBatch]:
+        # Timestamp of the frame the predictions come from, as given to submit
+        with self._lock:
+            return self.latest_sequence, self.latest_timestamp, self.latest_predictions
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
 
-if __name__ == "__main__":
-    import cv2
-    capture = cv2.VideoCapture(2)
-    egg_predicter = EggPredicter(0.1, capture)
 
+if __name__ == "__main__":
+    frame_grabber = FrameGrabber(2)
+    egg_predicter = EggPredicter(0.1, frame_grabber)
 
+    sequence = 0
     while True:
-        ret, frame = capture.read()
-        if not ret:
+        sequence, _, frame = frame_grabber.read_newer(sequence)
+        if frame is None:
             print("Error reading image from camera")
             exit()
         try:
@@ -72,10 +196,13 @@ if __name__ == "__main__":
         except Exception as e:
             print(e)
             continue
+        print(f"{egg_predicter.crops_per_second:.1f} crops/s")
+        egg_predicter.eggs_roi.draw(frame)
+        predictions.draw(frame)
         cv2.imshow('Predicter', frame)
 
         if cv2.waitKey(1) & 0xFF == ord('q'):
             break
 
-    capture.release()
+    frame_grabber.release()
     cv2.destroyAllWindows()
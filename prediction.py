@@ -1,7 +1,11 @@
 import cv2
-from typing import Literal
+import numpy as np
+from typing import Literal, TYPE_CHECKING
 from colors import ColorsBGR
 
+if TYPE_CHECKING:
+    from reference_system import ReferenceSystem
+
 
 class Prediction:
     cx: int
@@ -41,3 +45,104 @@ class Prediction:
                         fontScale=0.40,
                         color=(0, 255, 0),
                         thickness=1)
+
+
+class PredictionBatch:
+    CLASS_LABELS: tuple[str, str] = ("egg", "hole")
+    EGG: int = 0
+    HOLE: int = 1
+
+    cx: np.ndarray
+    cy: np.ndarray
+    width: np.ndarray
+    height: np.ndarray
+    confidence: np.ndarray
+    class_id: np.ndarray
+
+    def __init__(self, cx=(), cy=(), width=(), height=(), confidence=(), class_id=()):
+        self.cx = np.asarray(cx, dtype=np.int32)
+        self.cy = np.asarray(cy, dtype=np.int32)
+        self.width = np.asarray(width, dtype=np.int32)
+        self.height = np.asarray(height, dtype=np.int32)
+        self.confidence = np.asarray(confidence, dtype=np.float32)
+        self.class_id = np.asarray(class_id, dtype=np.uint8)
+
+    @classmethod
+    def from_results(cls, results: list[dict], offset_x: int = 0, offset_y: int = 0) -> "PredictionBatch":
+        if not results:
+            return cls()
+        values = np.array([(r["x"], r["y"], r["width"], r["height"], r["confidence"])
+                           for r in results], dtype=np.float64)
+        class_id = [PredictionBatch.EGG if r["class"] == "eggs" else PredictionBatch.HOLE
+                    for r in results]
+        return cls(values[:, 0].astype(np.int32) + offset_x,
+                   values[:, 1].astype(np.int32) + offset_y,
+                   values[:, 2], values[:, 3], values[:, 4], class_id)
+
+    def __len__(self) -> int:
+        return len(self.cx)
+
+    def __getitem__(self, index: int) -> Prediction:
+        return Prediction(int(self.cx[index]), int(self.cy[index]),
+                          int(self.width[index]), int(self.height[index]),
+                          float(self.confidence[index]),
+                          "eggs" if self.class_id[index] == PredictionBatch.EGG else "hole")
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def select(self, mask: np.ndarray) -> "PredictionBatch":
+        return PredictionBatch(self.cx[mask], self.cy[mask], self.width[mask], self.height[mask],
+                               self.confidence[mask], self.class_id[mask])
+
+    def filter_class(self, class_label: Literal["egg", "hole"]) -> "PredictionBatch":
+        return self.select(self.class_id == PredictionBatch.CLASS_LABELS.index(class_label))
+
+    def filter_confidence(self, min_confidence: float) -> "PredictionBatch":
+        return self.select(self.confidence >= min_confidence)
+
+    def centroids(self) -> np.ndarray:
+        return np.stack((self.cx, self.cy), axis=1)
+
+    def robot_coordinates(self, reference_system: "ReferenceSystem") -> np.ndarray:
+        return reference_system.get_robot_coordinates_batch(self.centroids())
+
+    def class_labels(self) -> np.ndarray:
+        return np.array(PredictionBatch.CLASS_LABELS)[self.class_id]
+
+    def draw(self, frame: cv2.typing.MatLike, /, numbered: bool = False):
+        if not len(self):
+            return
+        half_width = self.width // 2
+        half_height = self.height // 2
+        left, right = self.cx - half_width, self.cx + half_width
+        top, bottom = self.cy - half_height, self.cy + half_height
+        # (N, 4, 2) corners so every rectangle of a class is drawn in one call
+        corners = np.stack((np.stack((left, top), axis=1),
+                            np.stack((right, top), axis=1),
+                            np.stack((right, bottom), axis=1),
+                            np.stack((left, bottom), axis=1)), axis=1)
+        for class_id, color in ((PredictionBatch.EGG, ColorsBGR.EGG_PREDICTION),
+                                (PredictionBatch.HOLE, ColorsBGR.HOLE_PREDICTION)):
+            mask = self.class_id == class_id
+            if mask.any():
+                cv2.polylines(frame, list(corners[mask]), isClosed=True,
+                              color=color, thickness=1)
+
+        for i in range(len(self)):
+            color = ColorsBGR.EGG_PREDICTION if self.class_id[i] == PredictionBatch.EGG else ColorsBGR.HOLE_PREDICTION
+            cv2.circle(frame, (int(self.cx[i]), int(self.cy[i])), 2, (0, 255, 0), 2)
+            cv2.putText(frame,
+                        f"{self.confidence[i]:.2f}",
+                        (int(left[i]), int(top[i]) - 10),
+                        cv2.FONT_ITALIC,
+                        fontScale=0.5,
+                        color=color,
+                        thickness=1)
+            if numbered:
+                cv2.putText(frame, f"{i}",
+                            (int(self.cx[i]) + 10, int(self.cy[i]) + 5),
+                            cv2.FONT_ITALIC,
+                            fontScale=0.40,
+                            color=(0, 255, 0),
+                            thickness=1)
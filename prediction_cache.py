@@ -0,0 +1,60 @@
+import threading
+import time
+import cv2
+import numpy as np
+from prediction import PredictionBatch
+
+
+class PredictionCache:
+    SIGNATURE_SIZE: tuple[int, int] = (32, 32)
+    # Mean absolute difference (0-255) between signatures to consider the ROI changed
+    CHANGE_THRESHOLD: float = 4.0
+    MAX_AGE_SECONDS: float = 2.0
+
+    signature: np.ndarray | None
+    predictions: PredictionBatch
+    timestamp: float
+    hits: int
+    misses: int
+
+    def __init__(self, change_threshold: float = CHANGE_THRESHOLD, max_age_seconds: float = MAX_AGE_SECONDS):
+        self.change_threshold = change_threshold
+        self.max_age_seconds = max_age_seconds
+        self.signature = None
+        self.predictions = PredictionBatch()
+        self.timestamp = 0.0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def compute_signature(roi_frame: cv2.typing.MatLike) -> np.ndarray:
+        gray = cv2.cvtColor(roi_frame, cv2.COLOR_BGR2GRAY)
+        return cv2.resize(gray, PredictionCache.SIGNATURE_SIZE,
+                          interpolation=cv2.INTER_AREA).astype(np.int16)
+
+    def get(self, signature: np.ndarray) -> PredictionBatch | None:
+        with self._lock:
+            if self.signature is None \
+                    or self.signature.shape != signature.shape \
+                    or time.monotonic() - self.timestamp > self.max_age_seconds \
+                    or np.abs(signature - self.signature).mean() > self.change_threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return self.predictions
+
+    def store(self, signature: np.ndarray, predictions: PredictionBatch):
+        with self._lock:
+            self.signature = signature
+            self.predictions = predictions
+            self.timestamp = time.monotonic()
+
+    def invalidate(self):
+        with self._lock:
+            self.signature = None
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
@@ -0,0 +1,156 @@
+import cv2
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from roi import ROI
+
+
+class CircleDetection:
+    label: str
+    position: np.ndarray
+    radius: float
+    quality: float
+    spread_px: float
+    detections: int
+    frames: int
+
+    def __init__(self, label: str, position: np.ndarray, radius: float, quality: float,
+                 spread_px: float, detections: int, frames: int):
+        self.label = label
+        self.position = position
+        self.radius = radius
+        self.quality = quality
+        self.spread_px = spread_px
+        self.detections = detections
+        self.frames = frames
+
+    def __str__(self) -> str:
+        return (f"{self.label}: ({self.position[0]:.2f}, {self.position[1]:.2f}) r={self.radius:.1f} "
+                f"quality={self.quality:.2f} spread={self.spread_px:.2f}px "
+                f"{self.detections}/{self.frames} frames")
+
+
+class ReferenceLocator:
+    FRAMES: int = 10
+    # Detections further than this from the median centre are outliers
+    MAX_DEVIATION_PX: float = 3.0
+    MIN_QUALITY: float = 0.5
+
+    executor: ThreadPoolExecutor
+
+    def __init__(self, max_workers: int = 4):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="locator")
+
+    @staticmethod
+    def detect(roi_frame: cv2.typing.MatLike) -> tuple[float, float, float] | None:
+        # Largest circle in the ROI, centre refined to sub-pixel on the marker's blob
+        gray = cv2.cvtColor(roi_frame, cv2.COLOR_BGR2GRAY)
+        gray_blurred = cv2.GaussianBlur(gray, (9, 9), 2)
+        circles = cv2.HoughCircles(
+            gray_blurred,
+            method=cv2.HOUGH_GRADIENT,
+            dp=1,
+            minDist=50,
+            param1=50,
+            param2=32,
+            minRadius=5,
+            maxRadius=50
+        )
+        if circles is None:
+            return None
+        x, y, radius = max(circles[0], key=lambda c: c[2])
+        refined = ReferenceLocator.refine_center(gray_blurred, x, y, radius)
+        if refined is not None:
+            x, y = refined
+        return float(x), float(y), float(radius)
+
+    @staticmethod
+    def refine_center(gray: cv2.typing.MatLike, x: float, y: float,
+                      radius: float) -> tuple[float, float] | None:
+        # Hough centres are quantised to the accumulator, the centroid of the
+        # thresholded marker around it isn't
+        margin = int(radius * 1.5) + 2
+        x0, y0 = max(0, int(x) - margin), max(0, int(y) - margin)
+        x1 = min(gray.shape[1], int(x) + margin + 1)
+        y1 = min(gray.shape[0], int(y) + margin + 1)
+        window = gray[y0:y1, x0:x1]
+        if window.size == 0:
+            return None
+        _, binary = cv2.threshold(
+            window, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        cx, cy = int(x) - x0, int(y) - y0
+        if binary[cy, cx] == 0:
+            # Dark marker on a light background
+            binary = cv2.bitwise_not(binary)
+        _, labels, stats, centroids = cv2.connectedComponentsWithStats(binary)
+        label = labels[cy, cx]
+        area = stats[label, cv2.CC_STAT_AREA]
+        # A blob much bigger or smaller than the circle isn't the marker alone
+        if not 0.5 < area / (np.pi * radius ** 2) < 1.5:
+            return None
+        return centroids[label][0] + x0, centroids[label][1] + y0
+
+    @staticmethod
+    def locate_roi(label: str, roi: ROI, frames: list[np.ndarray]) -> CircleDetection | None:
+        detections = []
+        for frame in frames:
+            detection = ReferenceLocator.detect(roi.get_frame(frame))
+            if detection is not None:
+                detections.append(detection)
+        if not detections:
+            return None
+
+        detections = np.array(detections)
+        median = np.median(detections[:, :2], axis=0)
+        deviations = np.linalg.norm(detections[:, :2] - median, axis=1)
+        inliers = detections[deviations <= ReferenceLocator.MAX_DEVIATION_PX]
+        if not len(inliers):
+            return None
+
+        position = inliers[:, :2].mean(axis=0)
+        spread = float(np.median(np.linalg.norm(inliers[:, :2] - position, axis=1)))
+        # Consistent across frames and tightly clustered is 1
+        quality = len(inliers) / len(frames) * \
+            max(0.0, 1 - spread / ReferenceLocator.MAX_DEVIATION_PX)
+        return CircleDetection(label, position + (roi.x, roi.y), float(np.median(inliers[:, 2])),
+                               quality, spread, len(inliers), len(frames))
+
+    def locate(self, rois: dict[str, ROI], frames: list[np.ndarray]) -> dict[str, CircleDetection | None]:
+        # Each ROI on its own thread, OpenCV releases the GIL
+        futures = {label: self.executor.submit(ReferenceLocator.locate_roi, label, roi, frames)
+                   for label, roi in rois.items()}
+        return {label: future.result() for label, future in futures.items()}
+
+    @staticmethod
+    def reliable(detections: dict[str, CircleDetection | None]) -> dict[str, CircleDetection]:
+        return {label: detection for label, detection in detections.items()
+                if detection is not None and detection.quality >= ReferenceLocator.MIN_QUALITY}
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    import time
+    # Synthetic frames: dark markers with sub-pixel centres and some noise
+    centers = {"reference_1": (60.3, 52.7), "reference_2": (251.6, 48.2)}
+    rois = {}
+    for label, (x, y) in centers.items():
+        rois[label] = ROI(label)
+        rois[label].x, rois[label].y = int(x) - 40, int(y) - 40
+        rois[label].width, rois[label].height = 80, 80
+    frames = []
+    for _ in range(ReferenceLocator.FRAMES):
+        frame = np.full((120, 320, 3), 200, dtype=np.uint8)
+        for x, y in centers.values():
+            cv2.circle(frame, (int(x * 16), int(y * 16)), 15 * 16, (40, 40, 40), -1,
+                       lineType=cv2.LINE_AA, shift=4)
+        frame = cv2.add(frame, np.random.randint(0, 20, frame.shape, dtype=np.uint8))
+        frames.append(frame)
+
+    locator = ReferenceLocator()
+    start_time = time.perf_counter()
+    detections = locator.locate(rois, frames)
+    print(f"{(time.perf_counter() - start_time) * 1000:.1f} ms")
+    for label, detection in detections.items():
+        print(detection, "expected", centers[label])
@@ -1,173 +1,261 @@
+import json
+import os
 import cv2
 import numpy as np
+from dotenv import dotenv_values
 from roi import ROI
+from frame_grabber import FrameGrabber
+from calibration_store import calibration_store
+from instrumentation import instrumentation
+from reference_locator import ReferenceLocator, CircleDetection
+from lens_calibration import LensCalibration
+
+config = dotenv_values(".env")
 
 
 class ReferenceCircle:
     position_camera: np.array
-    radius_camera: int
+    radius_camera: float
     position_robot: np.array
     roi: ROI
     label: str
 
-    def __init__(self, label: str, position_robot: tuple | list, capture: cv2.VideoCapture):
+    def __init__(self, label: str, position_robot: tuple | list, frame_grabber: FrameGrabber, /,
+                 interactive: bool = True):
         self.position_robot = np.array(position_robot, dtype=np.float32)
         self.label = label
         self.roi = ROI(label)
-        self.roi.load(capture)
+        self.roi.load(frame_grabber, interactive=interactive)
         self.position_camera = None
         self.radius_camera = None
+        self.load_position_camera()
 
-        try:
-            with open(f"position_camera_{self.label}.txt") as f:
-                position_camera_str = f.read().rstrip("\n").split(",")
-                x, y, radius = [int(i) for i in position_camera_str]
-                self.position_camera = np.array((x, y))
-                self.radius_camera = radius
-        except Exception as e:
+    def load_position_camera(self):
+        circle = calibration_store.get_reference_circle(self.label)
+        if circle is None:
             print(f"Couldn't read camera position of {self.label}")
-            # exit()
+            return
+        x, y, radius = circle
+        self.position_camera = np.array((x, y), dtype=np.float64)
+        self.radius_camera = radius
 
-    def update_roi(self, capture: cv2.VideoCapture):
-        self.roi.save(capture)
+    def update_roi(self, frame_grabber: FrameGrabber):
+        self.roi.save(frame_grabber)
 
     def draw(self, frame: cv2.typing.MatLike):
         self.roi.draw(frame)
         if self.position_camera is not None:
+            center = (round(self.position_camera[0]), round(self.position_camera[1]))
             cv2.circle(frame,
-                       (self.position_camera[0],
-                        self.position_camera[1]),
-                       self.radius_camera,
+                       center,
+                       round(self.radius_camera),
                        (0, 140, 255),
                        thickness=1)
             cv2.circle(frame,
-                       (self.position_camera[0],
-                        self.position_camera[1]),
+                       center,
                        2,
                        (0, 140, 255),
                        thickness=4)
         else:
             print("position camera is None")
 
-    def update_position_camera(self, capture: cv2.VideoCapture):
-        self.roi.load(capture)
-
-        max_circle = None
-
-        for i in range(10):
-            ret, frame = capture.read()
-            roi_frame = self.roi.get_frame(frame)
-
-            gray = cv2.cvtColor(roi_frame, cv2.COLOR_BGR2GRAY)
-            gray_blurred = cv2.GaussianBlur(gray, (9, 9), 2)
-            circles = cv2.HoughCircles(
-                gray_blurred,
-                method=cv2.HOUGH_GRADIENT,
-                dp=1,
-                minDist=50,
-                param1=50,
-                param2=32,
-                minRadius=5,
-                maxRadius=50
-            )
-
-            if circles is not None:
-                circles = np.uint16(np.around(circles))
-                for i in circles[0, :]:
-                    if max_circle is None or i[2] > max_circle[2]:
-                        print("new max circle!")
-                        max_circle = i
-
-        if max_circle is not None:
-            cv2.circle(frame,
-                       (max_circle[0] + self.roi.x,
-                        max_circle[1] + self.roi.y),
-                       max_circle[2],
-                       (0, 140, 255),
-                       thickness=1)
-            cv2.circle(frame,
-                       (max_circle[0] + self.roi.x, max_circle[1]+self.roi.y),
-                       2,
-                       (0, 140, 255),
-                       thickness=2)
-
-            self.position_camera = np.array(
-                (max_circle[0]+self.roi.x,
-                 max_circle[1]+self.roi.y))
-            self.radius_camera = max_circle[2]
-
-            with open(f"position_camera_{self.label}.txt", "w") as f:
-                write_str = f"{self.position_camera[0]},{self.position_camera[1]},{self.radius_camera}\n"
-                f.write(write_str)
-
-        self.roi.draw(frame)
-        cv2.imshow("Reference Circle", frame)
-        cv2.waitKey(0)
-        print("destroying windows")
-        cv2.destroyAllWindows()
+    def set_detection(self, detection: CircleDetection):
+        self.position_camera = detection.position
+        self.radius_camera = detection.radius
+        calibration_store.set_reference_circle(
+            self.label, self.position_camera[0], self.position_camera[1], self.radius_camera,
+            quality=detection.quality)
+
+    def update_position_camera(self, frame_grabber: FrameGrabber) -> bool:
+        self.roi.load(frame_grabber)
+        frames = frame_grabber.read_frames(ReferenceLocator.FRAMES)
+        if not frames:
+            print("Error reading image from camera")
+            return False
+        detection = ReferenceLocator.locate_roi(self.label, self.roi, frames)
+        if detection is None or detection.quality < ReferenceLocator.MIN_QUALITY:
+            print(f"Couldn't locate {self.label}: {detection}")
+            return False
+        print(detection)
+        self.set_detection(detection)
+        return True
+
+
+DEFAULT_MARKERS = (
+    {"label": "reference_1", "x": 132, "y": 79},
+    {"label": "reference_2", "x": -138, "y": 91},
+    {"label": "reference_3", "x": -138, "y": 337},
+    {"label": "reference_4", "x": 132, "y": 335},
+)
 
 
 class ReferenceSystem:
-    reference_1: ReferenceCircle
-    reference_2: ReferenceCircle
-    reference_3: ReferenceCircle
-    reference_4: ReferenceCircle
+    MARKERS_FILE: str = config.get("REFERENCE_MARKERS_FILE", "reference_markers.json")
+    # Residuals above this are reported as suspicious markers
+    MAX_RESIDUAL_MM: float = 2.0
 
-    reference_1_aux: np.array
-    reference_2_aux: np.array
-    reference_3_aux: np.array
-    reference_4_aux: np.array
+    references: tuple[ReferenceCircle, ...]
+    positions_aux: np.ndarray
+    lens: LensCalibration | None
+    residuals_mm: dict[str, float]
 
     TRANSFORMATION_MATRIX = np.array(((-1, 0), (0, 1)))
+    # Automatic attempts before the operator is asked for the ROIs again
+    MAX_ATTEMPTS: int = 3
     homography_matrix: np.array
-
-    def __init__(self, capture: cv2.VideoCapture):
-        self.reference_1 = ReferenceCircle("reference_1", (132, 79), capture)
-        self.reference_2 = ReferenceCircle("reference_2", (-138, 91), capture)
-        self.reference_3 = ReferenceCircle("reference_3", (-138, 337), capture)
-        self.reference_4 = ReferenceCircle("reference_4", (132, 335), capture)
-
-        self.reference_1_aux = np.array((0, 0))
-        self.reference_2_aux = ReferenceSystem.TRANSFORMATION_MATRIX @ (
-            self.reference_2.position_robot - self.reference_1.position_robot)
-        self.reference_3_aux = ReferenceSystem.TRANSFORMATION_MATRIX @ (
-            self.reference_3.position_robot - self.reference_1.position_robot)
-        self.reference_4_aux = ReferenceSystem.TRANSFORMATION_MATRIX @ (
-            self.reference_4.position_robot - self.reference_1.position_robot)
-
-        self.update_homography_matrix()
+    camera_to_robot_matrix: np.array
+    locator: ReferenceLocator
+    missing_references: list[ReferenceCircle]
+
+    def __init__(self, frame_grabber: FrameGrabber, /, markers_file: str | None = MARKERS_FILE,
+                 interactive: bool = True):
+        # Any number of markers from 4 up, the first one is the origin of the aux frame
+        self.references = tuple(
+            ReferenceCircle(marker["label"], (marker["x"], marker["y"]), frame_grabber,
+                            interactive=interactive)
+            for marker in ReferenceSystem.load_markers(markers_file))
+        self.positions_aux = np.array(
+            [ReferenceSystem.TRANSFORMATION_MATRIX @ (circle.position_robot - self.references[0].position_robot)
+             for circle in self.references])
+
+        self.lens = LensCalibration.load()
+        self.residuals_mm = {}
+        self.locator = ReferenceLocator()
+        self.missing_references = []
+        self.load_homography_matrix()
+
+    @staticmethod
+    def load_markers(markers_file: str | None = MARKERS_FILE) -> list[dict]:
+        if markers_file is None or not os.path.exists(markers_file):
+            return list(DEFAULT_MARKERS)
+        with open(markers_file) as f:
+            markers = json.load(f)["markers"]
+        if len(markers) < 4:
+            raise ValueError(
+                f"{markers_file} has {len(markers)} markers, a homography needs at least 4")
+        return markers
+
+    def _source_points(self) -> list:
+        return [[round(float(v), 2) for v in circle.position_camera] for circle in self.references]
+
+    def load_homography_matrix(self):
+        H = None
+        if all(circle.position_camera is not None for circle in self.references):
+            H = calibration_store.get_homography(self._source_points())
+        if H is None:
+            self.update_homography_matrix()
+            return
+        self._set_homography_matrix(np.array(H))
+
+    def locate_reference_circles(self, frame_grabber: FrameGrabber) -> bool:
+        # All circles from the same frames, no windows or clicks
+        frames = frame_grabber.read_frames(ReferenceLocator.FRAMES)
+        if not frames:
+            print("Error reading image from camera")
+            return False
+        self.missing_references = []
+        detections = self.locator.locate(
+            {circle.label: circle.roi for circle in self.references}, frames)
+        located = ReferenceLocator.reliable(detections)
+        for circle in self.references:
+            print(located.get(circle.label, f"Couldn't locate {circle.label}: {detections[circle.label]}"))
+        if len(located) < len(self.references):
+            # Keep what was found, the next attempt only has to find the rest
+            for circle in self.references:
+                if circle.label in located:
+                    circle.set_detection(located[circle.label])
+                else:
+                    self.missing_references.append(circle)
+            return False
+        if not self.apply_detections(located):
+            # Degenerate layout, no single circle to blame
+            self.missing_references = list(self.references)
+            return False
+        return True
+
+    def apply_detections(self, detections: dict[str, CircleDetection]) -> bool:
+        # The homography is computed before anything changes, so readers see
+        # either the old calibration or the new one
+        H = self.compute_homography(
+            [detections[circle.label].position for circle in self.references])
+        if H is None:
+            return False
+        for circle in self.references:
+            circle.set_detection(detections[circle.label])
+        self._store_homography_matrix(H)
+        return True
+
+    def reload_calibration(self):
+        for circle in self.references:
+            circle.roi.reload()
+            circle.load_position_camera()
+        self.lens = LensCalibration.load()
+        self.load_homography_matrix()
 
     def update_homography_matrix(self):
-        source_points = np.array(
-            (
-                self.reference_1.position_camera,
-                self.reference_2.position_camera,
-                self.reference_3.position_camera,
-                self.reference_4.position_camera
-            )).reshape(-1, 1, 2)
-        destination_points = np.array(
-            (
-                self.reference_1_aux,
-                self.reference_2_aux,
-                self.reference_3_aux,
-                self.reference_4_aux
-            )).reshape(-1, 1, 2)
-
+        if any(circle.position_camera is None for circle in self.references):
+            print("Missing reference circles, homography not updated")
+            return
+        H = self.compute_homography(
+            [circle.position_camera for circle in self.references])
+        if H is None:
+            return
+        self._store_homography_matrix(H)
+
+    def undistort_points(self, points_camera: np.ndarray) -> np.ndarray:
+        # Raw camera pixels to the undistorted pixels predictions are given in
+        if self.lens is None:
+            return np.asarray(points_camera, dtype=np.float64).reshape(-1, 2)
+        return self.lens.undistort_points(points_camera)
+
+    def compute_homography(self, positions_camera: list[np.ndarray]) -> np.ndarray | None:
+        # Circle centres are found on the raw frame, the homography works on undistorted pixels
+        source_points = self.undistort_points(positions_camera).reshape(-1, 1, 2)
+        destination_points = self.positions_aux.reshape(-1, 1, 2)
+
+        # With more than 4 markers RANSAC drops the bad ones and refines on the rest
         H, mask = cv2.findHomography(
             source_points, destination_points, cv2.RANSAC, 5.0)
+        if H is None:
+            print("Couldn't compute homography")
+        return H
+
+    def compute_residuals(self) -> dict[str, float]:
+        positions_robot = self.get_robot_coordinates_batch(self.undistort_points(
+            [circle.position_camera for circle in self.references]))
+        return {circle.label: round(float(np.linalg.norm(position - circle.position_robot)), 3)
+                for circle, position in zip(self.references, positions_robot)}
+
+    def _store_homography_matrix(self, H: np.ndarray):
+        self._set_homography_matrix(H)
+        calibration_store.set_homography(H.tolist(), self._source_points(),
+                                         residuals_mm=self.residuals_mm)
+
+    def _set_homography_matrix(self, H: np.ndarray):
         self.homography_matrix = H
 
-    def get_robot_coordinates(self, target_x_camera: int, target_y_camera: int):
-        target_point_camera = np.array((target_x_camera, target_y_camera, 1))
-        target_point_robot_new = self.homography_matrix @ target_point_camera
-        target_point_camera = target_point_camera[:2]
-        target_point_robot = np.array((0, 0))
-        target_point_robot[0] = self.reference_1.position_robot[0] - \
-            target_point_robot_new[0]
-        target_point_robot[1] = self.reference_1.position_robot[1] + \
-            target_point_robot_new[1]
+        # Undo the axis flip and the reference 1 offset after the homography,
+        # so a single perspective transform goes from camera pixels to robot mm
+        aux_to_robot_matrix = np.eye(3)
+        aux_to_robot_matrix[:2, :2] = ReferenceSystem.TRANSFORMATION_MATRIX
+        aux_to_robot_matrix[:2, 2] = self.references[0].position_robot
+        self.camera_to_robot_matrix = aux_to_robot_matrix @ H
+
+        self.residuals_mm = self.compute_residuals()
+        for label, residual in self.residuals_mm.items():
+            if residual > ReferenceSystem.MAX_RESIDUAL_MM:
+                print(f"{label} is {residual:.2f} mm off the homography, check its position")
+
+    def get_robot_coordinates(self, target_x_camera: float, target_y_camera: float) -> np.ndarray:
+        return self.get_robot_coordinates_batch(((target_x_camera, target_y_camera),))[0]
 
-        return target_point_robot
+    def get_robot_coordinates_batch(self, points_camera: np.ndarray) -> np.ndarray:
+        points_camera = np.asarray(
+            points_camera, dtype=np.float64).reshape(-1, 1, 2)
+        if len(points_camera) == 0:
+            return np.empty((0, 2))
+        with instrumentation.span("homography"):
+            return cv2.perspectiveTransform(points_camera, self.camera_to_robot_matrix).reshape(-1, 2)
 
 
 TRANSFORMATION_MATRIX = np.array(((-1, 0), (0, 1)))
@@ -181,32 +269,33 @@ def get_new_reference(new_zero: ReferenceCircle, current_reference: ReferenceCir
 
 if __name__ == "__main__":
     from predicter import EggPredicter
-    capture = cv2.VideoCapture(index=2)
-    egg_predicter = EggPredicter(confidence_threshold=0.15, capture=capture)
+    frame_grabber = FrameGrabber(2)
+    egg_predicter = EggPredicter(
+        confidence_threshold=0.15, frame_grabber=frame_grabber)
 
     # image = cv2.imread(
     #     "homography-2.png")
 
-    reference_1 = ReferenceCircle("reference_1", (132, 79), capture)
-    reference_2 = ReferenceCircle("reference_2", (-138, 91), capture)
-    reference_3 = ReferenceCircle("reference_3", (-138, 337), capture)
-    reference_4 = ReferenceCircle("reference_4", (132, 335), capture)
+    reference_1 = ReferenceCircle("reference_1", (132, 79), frame_grabber)
+    reference_2 = ReferenceCircle("reference_2", (-138, 91), frame_grabber)
+    reference_3 = ReferenceCircle("reference_3", (-138, 337), frame_grabber)
+    reference_4 = ReferenceCircle("reference_4", (132, 335), frame_grabber)
 
-    reference_1.update_roi(capture)
+    reference_1.update_roi(frame_grabber)
     while reference_1.position_camera is None:
-        reference_1.update_position_camera(capture)
+        reference_1.update_position_camera(frame_grabber)
 
-    reference_2.update_roi(capture)
+    reference_2.update_roi(frame_grabber)
     while reference_2.position_camera is None:
-        reference_2.update_position_camera(capture)
+        reference_2.update_position_camera(frame_grabber)
 
-    reference_3.update_roi(capture)
+    reference_3.update_roi(frame_grabber)
     while reference_3.position_camera is None:
-        reference_3.update_position_camera(capture)
+        reference_3.update_position_camera(frame_grabber)
 
-    reference_4.update_roi(capture)
+    reference_4.update_roi(frame_grabber)
     while reference_4.position_camera is None:
-        reference_4.update_position_camera(capture)
+        reference_4.update_position_camera(frame_grabber)
 
     # exit()
 
@@ -242,18 +331,20 @@ if __name__ == "__main__":
 
     H, mask = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC, 5.0)
 
+    sequence = 0
     while True:
-        ret, frame = capture.read()
-        if not ret:
+        sequence, _, frame = frame_grabber.read_newer(sequence)
+        if frame is None:
             print("Could not read camera")
             continue
-        reference_1.draw(frame)
-        reference_2.draw(frame)
-        reference_3.draw(frame)
-        reference_4.draw(frame)
 
         try:
+            # Inference on the clean frame, the circles are drawn afterwards
             predictions = egg_predicter.predict(frame)
+            reference_1.draw(frame)
+            reference_2.draw(frame)
+            reference_3.draw(frame)
+            reference_4.draw(frame)
             for i, p in enumerate(predictions):
                 target_point_camera = np.array((p.cx, p.cy, 1))
                 target_point_robot_new = H @ target_point_camera
@@ -280,5 +371,5 @@ if __name__ == "__main__":
         cv2.imshow('Reference System', frame)
         if cv2.waitKey(1) & 0xFF == ord('q'):
             break
-    capture.release()
+    frame_grabber.release()
     cv2.destroyAllWindows()
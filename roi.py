@@ -1,9 +1,12 @@
 import cv2
 from colors import ColorsBGR
-# from camera import capture
+from frame_grabber import FrameGrabber
+from calibration_store import calibration_store
 
 
 class ROI:
+    CAPTURE_ATTEMPTS: int = 3
+
     x: int
     y: int
     width: int
@@ -17,11 +20,15 @@ class ROI:
         self.height = None
         self.label = label
 
-    def _capture(self, capture: cv2.VideoCapture):
-        # capture = cv2.VideoCapture(index=2)
-        for i in range(10):
-            ret, frame = capture.read()
-        ret, frame = capture.read()
+    def _capture(self, frame_grabber: FrameGrabber):
+        frame = None
+        for _ in range(ROI.CAPTURE_ATTEMPTS):
+            _, _, frame = frame_grabber.read_newer(0, timeout=5.0)
+            if frame is not None:
+                break
+            print("Error reading image from camera")
+        if frame is None:
+            raise RuntimeError(f"No camera image to select the {self.label} ROI on")
         WINDOW_NAME = f'Select {self.label} ROI'
         roi = cv2.selectROI(WINDOW_NAME,
                             frame,
@@ -29,27 +36,26 @@ class ROI:
                             showCrosshair=True)
         cv2.destroyWindow(WINDOW_NAME)
         x, y, w, h = roi
-        # capture.release()
         return x, y, w, h
 
-    def save(self, capture: cv2.VideoCapture):
-        x, y, w, h = self._capture(capture)
-        with open(f"roi_{self.label}.txt", "w") as f:
-            f.write(f"{x},{y},{w},{h}\n")
+    def save(self, frame_grabber: FrameGrabber):
+        x, y, w, h = self._capture(frame_grabber)
+        calibration_store.set_roi(self.label, x, y, w, h)
 
-    def load(self, capture: cv2.VideoCapture):
-        try:
-            with open(f"roi_{self.label}.txt") as f:
-                roi_str = f.read().rstrip("\n").split(",")
-                self.x, self.y, self.width, self.height = [
-                    int(i) for i in roi_str]
+    def load(self, frame_grabber: FrameGrabber, /, interactive: bool = True):
+        roi = calibration_store.get_roi(self.label)
+        if roi is None:
+            if not interactive:
+                # No window to select it on, e.g. the headless runner
+                raise RuntimeError(f"No {self.label} ROI stored, run calibrate_rois.py first")
+            self.save(frame_grabber)
+            roi = calibration_store.get_roi(self.label)
+        self.x, self.y, self.width, self.height = roi
 
-        except Exception:
-            self.save(capture)
-            with open(f"roi_{self.label}.txt") as f:
-                roi_str = f.read().rstrip("\n").split(",")
-                self.x, self.y, self.width, self.height = [
-                    int(i) for i in roi_str]
+    def reload(self):
+        roi = calibration_store.get_roi(self.label)
+        if roi is not None:
+            self.x, self.y, self.width, self.height = roi
 
     def draw(self, frame: cv2.typing.MatLike):
         cv2.rectangle(frame,
@@ -1,13 +1,199 @@
-from serial import Serial
+from serial import Serial, SerialException, serial_for_url
+from concurrent.futures import Future
+from collections import deque
+from typing import Callable
+import re
+import threading
 import time
+from instrumentation import instrumentation
+
+
+class RobotStatus:
+    status: int
+    x: float
+    y: float
+    z: float
+    j1: float
+    j2: float
+    j3: float
+    j4: float
+
+    def __init__(self, status: int, x: float, y: float, z: float,
+                 j1: float, j2: float, j3: float, j4: float):
+        self.status = status
+        self.x = x
+        self.y = y
+        self.z = z
+        self.j1 = j1
+        self.j2 = j2
+        self.j3 = j3
+        self.j4 = j4
+
+
+class RobotError(Exception):
+    pass
+
+
+class RobotCommand:
+    command: str
+    queued_at: float
+    sent_at: float | None
+    acknowledged_at: float | None
+    completed_at: float | None
+    acknowledged: Future
+    completed: Future
+
+    def __init__(self, command: str):
+        self.command = command
+        self.queued_at = time.monotonic()
+        self.sent_at = None
+        self.acknowledged_at = None
+        self.completed_at = None
+        self.acknowledged = Future()
+        self.completed = Future()
+
+    @property
+    def size(self) -> int:
+        return len(self.command) + 1
+
+
+class CommandQueue:
+    # Like GRBL character counting: never send more bytes than the firmware
+    # serial buffer can hold, nor more than max_in_flight unacknowledged lines
+    RX_BUFFER_SIZE: int = 64
+    MAX_IN_FLIGHT: int = 4
+
+    scara_robot: "ScaraRobot"
+    queued_commands: deque[RobotCommand]
+    in_flight_commands: list[RobotCommand]
+    is_paused: bool
+
+    def __init__(self, scara_robot: "ScaraRobot", /,
+                 max_in_flight: int = MAX_IN_FLIGHT, rx_buffer_size: int = RX_BUFFER_SIZE):
+        self.scara_robot = scara_robot
+        self.max_in_flight = max_in_flight
+        self.rx_buffer_size = rx_buffer_size
+        self.queued_commands = deque()
+        self.in_flight_commands = []
+        self.is_paused = False
+        self._condition = threading.Condition()
+        self._is_running = True
+        self.thread = threading.Thread(target=self._send_loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, command: str) -> RobotCommand:
+        return self.submit_program((command,))[0]
+
+    def submit_program(self, commands: tuple[str, ...] | list[str]) -> list[RobotCommand]:
+        robot_commands = [RobotCommand(command) for command in commands]
+        for robot_command in robot_commands:
+            robot_command.acknowledged.add_done_callback(
+                lambda f, c=robot_command: self.on_acknowledged(c))
+            # A failed command invalidates the rest of the queue
+            robot_command.completed.add_done_callback(self._on_completed)
+        with self._condition:
+            self.queued_commands.extend(robot_commands)
+            self._condition.notify_all()
+        return robot_commands
+
+    def _bytes_in_flight(self) -> int:
+        return sum(c.size for c in self.in_flight_commands)
+
+    def _can_send(self) -> bool:
+        if self.is_paused or not self.queued_commands:
+            return False
+        if not self.in_flight_commands:
+            return True
+        return len(self.in_flight_commands) < self.max_in_flight and \
+            self._bytes_in_flight() + self.queued_commands[0].size <= self.rx_buffer_size
+
+    def _send_loop(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: not self._is_running or self._can_send())
+                if not self._is_running:
+                    return
+                robot_command = self.queued_commands.popleft()
+                self.in_flight_commands.append(robot_command)
+            self.scara_robot.write_command(robot_command)
+
+    def on_acknowledged(self, robot_command: RobotCommand):
+        # A cancelled command keeps its slot until the firmware really answers it
+        if robot_command.acknowledged_at is None and robot_command in self.in_flight_commands:
+            return
+        with self._condition:
+            if robot_command in self.in_flight_commands:
+                self.in_flight_commands.remove(robot_command)
+            self._condition.notify_all()
+
+    def _on_completed(self, future: Future):
+        if not future.cancelled() and future.exception() is not None:
+            self.flush()
+
+    def pause(self):
+        with self._condition:
+            self.is_paused = True
+
+    def resume(self):
+        with self._condition:
+            self.is_paused = False
+            self._condition.notify_all()
+
+    def flush(self):
+        with self._condition:
+            queued_commands = list(self.queued_commands)
+            self.queued_commands.clear()
+        for robot_command in queued_commands:
+            robot_command.acknowledged.cancel()
+            robot_command.completed.cancel()
+
+    def cancel(self):
+        # Commands already sent stay buffered in the firmware, they stay
+        # in flight until their replies arrive so none is taken for a new one
+        self.flush()
+        self.scara_robot.cancel_pending_commands()
+        with self._condition:
+            self._condition.notify_all()
+
+    def stop(self):
+        with self._condition:
+            self._is_running = False
+            self._condition.notify_all()
+        self.thread.join()
 
 
 class ScaraRobot:
+    STATUS_PATTERN = re.compile(
+        r"\[(\d+)\]XYZ:\(([\d.-]+),([\d.-]+),([\d.-]+)\);J1J2J3J4:\(([\d.-]+),([\d.-]+),([\d.-]+),([\d.-]+)\)")
+
     serial_port: Serial
+    state: RobotStatus | None
+    state_timestamp: float
+    pending_commands: deque[RobotCommand]
+    reader_thread: threading.Thread
+    command_queue: CommandQueue
+
+    def __init__(self, port: str, baudrate: int, /, reset_delay: float = 2.0):
+        # serial_for_url also accepts plain device paths and simulator ptys
+        self.serial_port = serial_for_url(port, baudrate, timeout=0.1)
+        # The Arduino resets when the port opens
+        time.sleep(reset_delay)
+        self.serial_port.reset_input_buffer()
+
+        self.state = None
+        self.state_timestamp = 0.0
+        self.pending_commands = deque()
+        self._status_callbacks = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
 
-    def __init__(self, port: str, baudrate: int):
-        self.serial_port = Serial(port, baudrate, timeout=1.0)
-        time.sleep(2)
+        self._is_reading = True
+        self.reader_thread = threading.Thread(
+            target=self._read_loop, daemon=True)
+        self.reader_thread.start()
+
+        self.command_queue = CommandQueue(self)
 
     def go_to_cartesian_coordinate(self, /,
                                    x: float | None = None,
@@ -81,11 +267,98 @@ class ScaraRobot:
         # self.send_command(g_code_command)
         return g_code_command
 
-    def send_command(self, command: str):
-        self.serial_port.write((command + "\n").encode())
+    def send_command(self, command: str) -> RobotCommand:
+        return self.command_queue.submit(command)
+
+    def write_command(self, robot_command: RobotCommand):
+        with self._write_lock:
+            with self._lock:
+                self.pending_commands.append(robot_command)
+            robot_command.sent_at = time.monotonic()
+            self.serial_port.write((robot_command.command + "\n").encode())
+
+    def add_status_callback(self, callback: Callable[[RobotStatus], None]):
+        self._status_callbacks.append(callback)
+
+    def cancel_pending_commands(self):
+        # Kept in pending_commands as tombstones, their late replies are absorbed
+        with self._lock:
+            pending_commands = list(self.pending_commands)
+        for robot_command in pending_commands:
+            robot_command.acknowledged.cancel()
+            robot_command.completed.cancel()
+
+    @staticmethod
+    def parse_status(response: str) -> RobotStatus | None:
+        match = ScaraRobot.STATUS_PATTERN.match(response)
+        if not match:
+            return None
+        return RobotStatus(int(match.group(1)),
+                           *(float(match.group(i)) for i in range(2, 9)))
+
+    def _read_loop(self):
+        while self._is_reading:
+            try:
+                line = self.serial_port.readline()
+            except (SerialException, TypeError, OSError):
+                # Port closed while waiting
+                break
+            if not line:
+                continue
+            response = line.decode(errors="replace").rstrip(
+                "&\r\n").lstrip("$")
+            if response:
+                self._handle_response(response)
+
+    def _handle_response(self, response: str):
+        robot_status = ScaraRobot.parse_status(response) \
+            if response.startswith("[") else None
+
+        with self._lock:
+            # Any line acknowledges the oldest command that hasn't been yet
+            acknowledged_command = None
+            for robot_command in self.pending_commands:
+                if robot_command.acknowledged_at is None:
+                    robot_command.acknowledged_at = time.monotonic()
+                    acknowledged_command = robot_command
+                    break
+            # A status line is sent once the firmware finished the command
+            robot_command = self.pending_commands.popleft() \
+                if robot_status is not None and self.pending_commands else None
+            if robot_status is not None:
+                self.state = robot_status
+                self.state_timestamp = time.monotonic()
+
+        if acknowledged_command is not None:
+            if acknowledged_command.acknowledged.done():
+                # Cancelled, its slot in the firmware buffer is free now
+                self.command_queue.on_acknowledged(acknowledged_command)
+            else:
+                acknowledged_command.acknowledged.set_result(response)
+        if robot_status is None:
+            return
+        for callback in self._status_callbacks:
+            callback(robot_status)
+        if robot_command is None or robot_command.completed.done():
+            return
+        robot_command.completed_at = time.monotonic()
+        instrumentation.record(f"robot.{robot_command.command.split(' ', 1)[0]}",
+                               robot_command.completed_at - robot_command.sent_at)
+        instrumentation.record("robot.queue_wait",
+                               robot_command.sent_at - robot_command.queued_at)
+        if robot_status.status == 0:
+            robot_command.completed.set_result(robot_status)
+        else:
+            robot_command.completed.set_exception(RobotError(
+                f"{robot_command.command} failed with status {robot_status.status}"))
 
-    def read_response(self):
-        return self.serial_port.read_all().decode()
+    def close(self):
+        self.command_queue.stop()
+        self.command_queue.flush()
+        self._is_reading = False
+        self.reader_thread.join()
+        self.cancel_pending_commands()
+        self.serial_port.close()
 
 
 if __name__ == "__main__":
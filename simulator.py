@@ -0,0 +1,194 @@
+import os
+import re
+import threading
+import time
+import tty
+from abc import ABC, abstractmethod
+from motion_planner import JointLimits, ScaraKinematics, DEFAULT_JOINT_LIMITS
+
+
+class SimulatedSerialDevice(ABC):
+    # Exposes a pseudo terminal so ScaraRobot/ConveyerBelt open it like real hardware
+    port: str
+
+    def __init__(self):
+        self._master_fd, slave_fd = os.openpty()
+        tty.setraw(slave_fd)
+        self.port = os.ttyname(slave_fd)
+        self._slave_fd = slave_fd
+        self._is_running = True
+        self.thread = threading.Thread(target=self._read_loop, daemon=True)
+        self.thread.start()
+
+    def _read_loop(self):
+        buffer = b""
+        while self._is_running:
+            try:
+                data = os.read(self._master_fd, 1024)
+            except OSError:
+                break
+            if not data:
+                continue
+            buffer = self.handle_data(buffer + data)
+
+    @abstractmethod
+    def handle_data(self, buffer: bytes) -> bytes:
+        ...
+
+    def write(self, response: str):
+        os.write(self._master_fd, response.encode())
+
+    def close(self):
+        self._is_running = False
+        os.close(self._slave_fd)
+        os.close(self._master_fd)
+
+
+class SimulatedScaraRobot(SimulatedSerialDevice):
+    GRIPPER_TIME_SECONDS: float = 0.3
+
+    COMMAND_PATTERN = re.compile(r"^G(\d+)((?:\s+[A-Z]-?[\d.]+)*)\s*$")
+    PARAMETER_PATTERN = re.compile(r"([A-Z])(-?[\d.]+)")
+
+    joints: list[float]
+    joint_limits: tuple[JointLimits, ...]
+    kinematics: ScaraKinematics
+    gripper_value: int
+    commands_received: int
+
+    def __init__(self, /, joint_limits: tuple[JointLimits, ...] = DEFAULT_JOINT_LIMITS,
+                 kinematics: ScaraKinematics | None = None, time_scale: float = 1.0):
+        self.joint_limits = joint_limits
+        self.kinematics = kinematics if kinematics is not None else ScaraKinematics()
+        self.time_scale = time_scale
+        self.joints = [0.0, 0.0, 0.0, 0.0]
+        self.gripper_value = 0
+        self.commands_received = 0
+        self.busy_time = 0.0
+        super().__init__()
+
+    def status_line(self, status: int) -> str:
+        x, y = self.kinematics.forward(self.joints[0], self.joints[2])
+        j1, j2, j3, j4 = self.joints
+        return f"[{status}]XYZ:({x:.2f},{y:.2f},{j2:.2f});J1J2J3J4:({j1:.2f},{j2:.2f},{j3:.2f},{j4:.2f})\r\n"
+
+    def handle_data(self, buffer: bytes) -> bytes:
+        while b"\n" in buffer:
+            line, buffer = buffer.split(b"\n", 1)
+            command = line.decode(errors="replace").strip().upper()
+            if command:
+                self.commands_received += 1
+                self.write(self.status_line(self.execute(command)))
+        return buffer
+
+    def move_to(self, target_joints: list[float]):
+        move_time = max(limits.move_time(target - current)
+                        for limits, target, current in zip(self.joint_limits, target_joints, self.joints))
+        self.busy_time += move_time
+        time.sleep(move_time * self.time_scale)
+        self.joints = target_joints
+
+    def execute(self, command: str) -> int:
+        match = SimulatedScaraRobot.COMMAND_PATTERN.match(command)
+        if match is None:
+            return 1
+        code = int(match.group(1))
+        parameters = {name: float(value) for name, value in
+                      SimulatedScaraRobot.PARAMETER_PATTERN.findall(match.group(2))}
+
+        if code == 0:
+            x, y = self.kinematics.forward(self.joints[0], self.joints[2])
+            solution = self.kinematics.inverse(
+                parameters.get("X", x), parameters.get("Y", y))
+            if solution is None:
+                return 2
+            j1, j3 = solution
+            self.move_to([j1, parameters.get("Z", self.joints[1]),
+                          j3, self.joints[3]])
+        elif code == 10:
+            self.move_to([0.0, 0.0, 0.0, 0.0])
+        elif code in (11, 12):
+            target_joints = [parameters.get("H", self.joints[0]),
+                             parameters.get("J", self.joints[1]),
+                             parameters.get("K", self.joints[2]),
+                             parameters.get("L", self.joints[3])]
+            if code == 11:
+                self.move_to(target_joints)
+            else:
+                self.joints = target_joints
+        elif code == 20:
+            self.gripper_value = int(parameters.get("P", 255))
+            self.busy_time += SimulatedScaraRobot.GRIPPER_TIME_SECONDS
+            time.sleep(SimulatedScaraRobot.GRIPPER_TIME_SECONDS * self.time_scale)
+        elif code == 21:
+            self.gripper_value = 0
+            self.busy_time += SimulatedScaraRobot.GRIPPER_TIME_SECONDS
+            time.sleep(SimulatedScaraRobot.GRIPPER_TIME_SECONDS * self.time_scale)
+        else:
+            return 1
+        return 0
+
+
+class SimulatedConveyerBelt(SimulatedSerialDevice):
+    is_moving: bool
+    speed_mm_s: float
+
+    def __init__(self, /, speed_mm_s: float = 50.0):
+        self.speed_mm_s = speed_mm_s
+        self.is_moving = False
+        self._position_mm = 0.0
+        self._last_change = time.monotonic()
+        super().__init__()
+
+    @property
+    def position_mm(self) -> float:
+        if self.is_moving:
+            return self._position_mm + self.speed_mm_s * (time.monotonic() - self._last_change)
+        return self._position_mm
+
+    def handle_data(self, buffer: bytes) -> bytes:
+        for byte in buffer:
+            if byte not in b"01":
+                continue
+            self._position_mm = self.position_mm
+            self._last_change = time.monotonic()
+            self.is_moving = byte == ord("1")
+        return b""
+
+
+if __name__ == "__main__":
+    from scara_robot import ScaraRobot
+    from conveyer_belt import ConveyerBelt
+    from supply_egg import SupplySystem
+    from motion_planner import MotionPlanner
+
+    simulated_robot = SimulatedScaraRobot(time_scale=0.1)
+    simulated_belt = SimulatedConveyerBelt()
+
+    belt = ConveyerBelt(simulated_belt.port, 115200, reset_delay=0)
+    scara_robot = ScaraRobot(simulated_robot.port, 115200, reset_delay=0)
+    supply_system = SupplySystem(state_file=None)
+
+    belt.move()
+    time.sleep(0.5)
+    belt.stop()
+    time.sleep(0.1)
+    print(f"belt position: {simulated_belt.position_mm:.1f} mm")
+
+    motion_planner = MotionPlanner(scara_robot)
+    for supply_egg in supply_system.supply_eggs:
+        legacy_commands = SupplySystem.pick_and_place_program(
+            scara_robot, supply_egg, 0, 200)
+        planned_commands = motion_planner.plan_pick_and_place(
+            supply_egg, 0, 200, start_joints=motion_planner.current_joints()).commands
+        for label, commands in (("legacy", legacy_commands), ("planned", planned_commands)):
+            start_time = time.monotonic()
+            busy_time = simulated_robot.busy_time
+            robot_program = scara_robot.command_queue.submit_program(commands)
+            robot_program[-1].completed.result(timeout=60)
+            print(f"{label} cycle: wall {time.monotonic() - start_time:.3f} s, "
+                  f"simulated motion {simulated_robot.busy_time - busy_time:.2f} s")
+
+    scara_robot.close()
+    simulated_robot.close()
+    simulated_belt.close()
@@ -1,20 +1,58 @@
+import json
+import os
+import tempfile
+import threading
+from typing import TYPE_CHECKING
 import numpy as np
+from dotenv import dotenv_values
+from scara_robot import ScaraRobot
+from frame_grabber import FrameGrabber
+from roi import ROI
+
+if TYPE_CHECKING:
+    from prediction import PredictionBatch
+    from reference_system import ReferenceSystem
+
+config = dotenv_values(".env")
+
+# Used when there is no trays file, the original single tray
+DEFAULT_TRAYS = {
+    "1": ({"x": 230, "y": 60, "j4": 75},
+          {"x": 280, "y": 50, "j4": 10},
+          {"x": 230, "y": 10, "j4": 83},
+          {"x": 280, "y": 0, "j4": 30},
+          {"x": 220, "y": -40, "j4": 91},
+          {"x": 270, "y": -50, "j4": 0}),
+}
 
 
 class SupplyEgg:
     grab_x_position_mm: float
     grab_y_position_mm: float
     grab_j4_angle_degrees: float
+    is_used: bool
+    missed_detections: int
+    tray: str
+    slot: int
 
-    def __init__(self, x: float, y: float, j4: float) -> None:
+    def __init__(self, x: float, y: float, j4: float, /, tray: str = "1", slot: int = 0) -> None:
         self.grab_x_position_mm = x
         self.grab_y_position_mm = y
         self.grab_j4_angle_degrees = j4
+        self.is_used = False
+        self.missed_detections = 0
+        self.tray = tray
+        self.slot = slot
+
+    @property
+    def key(self) -> str:
+        return f"{self.tray}:{self.slot}"
 
 
 class SupplySystem:
     supply_eggs: list[SupplyEgg]
-    next_egg_index: int
+    trays: dict[str, list[SupplyEgg]]
+    supply_roi: ROI | None
 
     SAFE_Z_POSITION_MM: float = -75
     APPROACH_Z_POSITION_MM: float = -125
@@ -22,13 +60,155 @@ class SupplySystem:
     GRAB_Z_POSITION_MM: float = -170
     GRAB_GRIPPER_VALUE: int = 135
 
-    def __init__(self) -> None:
-        self.supply_eggs = []
-        self.next_egg_index = 0
+    TRAYS_FILE: str = config.get("SUPPLY_TRAYS_FILE", "supply_trays.json")
+    STATE_FILE: str = config.get("SUPPLY_STATE_FILE", "supply_state.json")
+    DETECTION: bool = config.get("SUPPLY_DETECTION", "false").lower() == "true"
+    # A detected egg further than this from every slot is ignored. Detections go
+    # through the belt plane homography, the tray's eggs sit at another height so
+    # their positions are off by parallax, growing away from the camera's axis
+    DETECTION_MATCH_DISTANCE_MM: float = 15
+    # Inspections without an egg at a slot before it's taken as empty, the arm
+    # or a hand over the tray only hides it for a moment
+    MAX_MISSED_DETECTIONS: int = 3
+
+    def __init__(self, /, trays_file: str | None = TRAYS_FILE,
+                 state_file: str | None = STATE_FILE) -> None:
+        self.trays_file = trays_file
+        self.state_file = state_file
+        self.supply_roi = None
+        self._detected_predictions = None
+        self._lock = threading.Lock()
+
+        self.trays = {}
+        for tray, slots in self.load_layouts().items():
+            self.trays[tray] = [SupplyEgg(slot["x"], slot["y"], slot["j4"], tray=tray, slot=i)
+                                for i, slot in enumerate(slots)]
+        self.supply_eggs = [supply_egg for supply_eggs in self.trays.values()
+                            for supply_egg in supply_eggs]
+        self.load_state()
+
+    def load_layouts(self) -> dict:
+        if self.trays_file is None or not os.path.exists(self.trays_file):
+            return DEFAULT_TRAYS
+        with open(self.trays_file) as f:
+            return json.load(f)["trays"]
+
+    def load_state(self):
+        if self.state_file is None or not os.path.exists(self.state_file):
+            return
+        with open(self.state_file) as f:
+            used = set(json.load(f)["used"])
+        for supply_egg in self.supply_eggs:
+            supply_egg.is_used = supply_egg.key in used
+
+    def save_state(self):
+        if self.state_file is None:
+            return
+        with self._lock:
+            used = [supply_egg.key for supply_egg in self.supply_eggs
+                    if supply_egg.is_used]
+            # Same atomic replace as the calibration store, a crash never loses the tray state
+            directory = os.path.dirname(os.path.abspath(self.state_file))
+            fd, temporary_path = tempfile.mkstemp(
+                dir=directory, prefix=".supply-", suffix=".json")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump({"used": used}, f, indent=2)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temporary_path, self.state_file)
+            except Exception:
+                os.remove(temporary_path)
+                raise
+
+    def mark_used(self, supply_egg: SupplyEgg):
+        supply_egg.is_used = True
+        self.save_state()
+
+    def refill(self, tray: str | None = None):
+        for supply_egg in self.supply_eggs:
+            if tray is None or supply_egg.tray == tray:
+                supply_egg.is_used = False
+                supply_egg.missed_detections = 0
+        self.save_state()
+
+    def remaining_supply_eggs(self) -> list[SupplyEgg]:
+        return [supply_egg for supply_egg in self.supply_eggs if not supply_egg.is_used]
+
+    def nearest_supply_egg(self, target_x: float, target_y: float) -> SupplyEgg | None:
+        # The shortest supply to hole transit, the arm passes through both anyway
+        remaining_supply_eggs = self.remaining_supply_eggs()
+        if not remaining_supply_eggs:
+            return None
+        return min(remaining_supply_eggs,
+                   key=lambda supply_egg: (supply_egg.grab_x_position_mm - target_x) ** 2 +
+                   (supply_egg.grab_y_position_mm - target_y) ** 2)
+
+    def update_from_detections(self, points_robot: np.ndarray):
+        # An egg seen at a slot refills it at once, a slot is only emptied
+        # after several inspections in a row without one
+        points_robot = np.asarray(points_robot, dtype=np.float64).reshape(-1, 2)
+        is_changed = False
+        for supply_egg in self.supply_eggs:
+            position = np.array((supply_egg.grab_x_position_mm,
+                                 supply_egg.grab_y_position_mm))
+            distances = np.linalg.norm(points_robot - position, axis=1)
+            if np.any(distances <= SupplySystem.DETECTION_MATCH_DISTANCE_MM):
+                supply_egg.missed_detections = 0
+                if supply_egg.is_used:
+                    supply_egg.is_used = False
+                    is_changed = True
+            elif not supply_egg.is_used:
+                supply_egg.missed_detections += 1
+                if supply_egg.missed_detections >= SupplySystem.MAX_MISSED_DETECTIONS:
+                    supply_egg.is_used = True
+                    is_changed = True
+        if is_changed:
+            self.save_state()
+
+    def enable_detection(self, frame_grabber: FrameGrabber, /, interactive=True):
+        self.supply_roi = ROI("supply")
+        self.supply_roi.load(frame_grabber, interactive=interactive)
+
+    def detect(self, predictions: "PredictionBatch | None", reference_system: "ReferenceSystem") -> int:
+        # Predictions of the supply ROI, inferred in the same request as the carton.
+        # Only when a supply ROI was enabled, otherwise consumption is just counted
+        if self.supply_roi is None or predictions is None \
+                or predictions is self._detected_predictions:
+            # The same result again isn't another missed detection
+            return len(self.remaining_supply_eggs())
+        self._detected_predictions = predictions
+        eggs = predictions.filter_class("egg")
+        self.update_from_detections(eggs.robot_coordinates(reference_system))
+        return len(self.remaining_supply_eggs())
 
-        self.supply_eggs.append(SupplyEgg(x=230, y=60, j4=75))
-        self.supply_eggs.append(SupplyEgg(x=280, y=50, j4=10))
-        self.supply_eggs.append(SupplyEgg(x=230, y=10, j4=83))
-        self.supply_eggs.append(SupplyEgg(x=280, y=0, j4=30))
-        self.supply_eggs.append(SupplyEgg(x=220, y=-40, j4=91))
-        self.supply_eggs.append(SupplyEgg(x=270, y=-50, j4=0))
+    @staticmethod
+    def pick_and_place_program(scara_robot: ScaraRobot, supply_egg: SupplyEgg,
+                               target_x: float, target_y: float) -> tuple[str, ...]:
+        return (
+            scara_robot.go_to_articular_coordinate(
+                j2=SupplySystem.SAFE_Z_POSITION_MM),
+            scara_robot.go_to_cartesian_coordinate(
+                x=supply_egg.grab_x_position_mm,
+                y=supply_egg.grab_y_position_mm),
+            scara_robot.go_to_articular_coordinate(
+                j2=SupplySystem.APPROACH_Z_POSITION_MM),
+            scara_robot.go_to_articular_coordinate(
+                j4=supply_egg.grab_j4_angle_degrees),
+            scara_robot.go_to_articular_coordinate(
+                j2=SupplySystem.GRAB_Z_POSITION_MM),
+            scara_robot.act_tool(
+                value=SupplySystem.GRAB_GRIPPER_VALUE),
+            scara_robot.go_to_articular_coordinate(
+                j2=SupplySystem.SAFE_Z_POSITION_MM),
+            scara_robot.go_to_cartesian_coordinate(
+                x=round(target_x, 2), y=round(target_y, 2)),
+            scara_robot.go_to_articular_coordinate(
+                j2=SupplySystem.RELEASE_Z_POSITION_MM),
+            scara_robot.release_tool(),
+            scara_robot.go_to_articular_coordinate(
+                j2=SupplySystem.SAFE_Z_POSITION_MM),
+            scara_robot.go_to_articular_coordinate(
+                j1=0,
+                j3=0)
+        )
@@ -0,0 +1,540 @@
+import threading
+import time
+from concurrent.futures import CancelledError
+from enum import Enum
+from typing import Callable
+from frame_grabber import FrameGrabber
+from predicter import PredictionPipeline
+from reference_system import ReferenceSystem
+from scara_robot import RobotCommand, RobotError
+from conveyer_belt import ConveyerBelt
+from supply_egg import SupplySystem, SupplyEgg
+from motion_planner import MotionPlanner
+from batch_planner import BatchPlanner, BatchTrip
+from tracker import PredictionTracker, Track
+from placement_verifier import PlacementVerifier
+from instrumentation import instrumentation
+
+
+class RoutineState(Enum):
+    IDLE = "idle"
+    INSPECT = "inspect"
+    PLAN = "plan"
+    PICK = "pick"
+    PLACE = "place"
+    VERIFY = "verify"
+    FINISH = "finish"
+    ADVANCE_BELT = "advance_belt"
+    ERROR = "error"
+
+
+class RoutineEvent:
+    name: str
+    state: RoutineState
+    timestamp: float
+    fields: dict
+
+    def __init__(self, name: str, state: RoutineState, **fields):
+        self.name = name
+        self.state = state
+        self.timestamp = time.time()
+        self.fields = fields
+
+    def __str__(self) -> str:
+        fields = " ".join(f"{key}={value}" for key, value in self.fields.items())
+        return f"[{self.state.value}] {self.name} {fields}".strip()
+
+
+class StateTimeout(Exception):
+    pass
+
+
+class RoutineStopped(Exception):
+    pass
+
+
+class SupplyRoutine:
+    STATE_TIMEOUT_SECONDS: dict[RoutineState, float] = {
+        RoutineState.INSPECT: 10.0,
+        RoutineState.PLAN: 2.0,
+        RoutineState.PICK: 30.0,
+        RoutineState.PLACE: 30.0,
+        RoutineState.VERIFY: 10.0,
+        RoutineState.FINISH: 30.0,
+        RoutineState.ADVANCE_BELT: 30.0,
+    }
+    # Where to go when a state runs out of time
+    TIMEOUT_STATES: dict[RoutineState, RoutineState] = {
+        # An unsettled scene isn't proof the carton is full, it must not move on
+        RoutineState.INSPECT: RoutineState.ERROR,
+        RoutineState.PLAN: RoutineState.ERROR,
+        RoutineState.PICK: RoutineState.ERROR,
+        RoutineState.PLACE: RoutineState.ERROR,
+        RoutineState.VERIFY: RoutineState.ERROR,
+        RoutineState.FINISH: RoutineState.ERROR,
+        RoutineState.ADVANCE_BELT: RoutineState.INSPECT,
+    }
+    POLL_SECONDS: float = 0.02
+    # Rounds of planning with the lead time of the previous round
+    PREDICTION_ITERATIONS: int = 3
+    # Frames right after the arm leaves the hole can still show it (exposure, transport)
+    VERIFY_SETTLE_SECONDS: float = 0.3
+    MIN_FILLED_SCORE: float = 0.5
+    MAX_PLACEMENT_RETRIES: int = 1
+    SUPPLY_POLL_SECONDS: float = 1.0
+
+    frame_grabber: FrameGrabber
+    prediction_pipeline: PredictionPipeline
+    reference_system: ReferenceSystem
+    supply_system: SupplySystem
+    motion_planner: MotionPlanner
+    batch_planner: BatchPlanner
+    tracker: PredictionTracker
+    placement_verifier: PlacementVerifier
+    belt: ConveyerBelt | None
+    batch_filling: bool
+    continuous_belt: bool
+    filled_track_ids: set[int]
+    unverified_holes: dict[int, float]
+    placement_retries: dict[int, int]
+    state: RoutineState
+    trips: list[BatchTrip]
+    trip_index: int
+    thread: threading.Thread | None
+
+    def __init__(self, frame_grabber: FrameGrabber, prediction_pipeline: PredictionPipeline,
+                 reference_system: ReferenceSystem, supply_system: SupplySystem,
+                 motion_planner: MotionPlanner, /, tracker: PredictionTracker | None = None,
+                 belt: ConveyerBelt | None = None, batch_filling: bool = False,
+                 continuous_belt: bool = False):
+        self.frame_grabber = frame_grabber
+        self.prediction_pipeline = prediction_pipeline
+        self.reference_system = reference_system
+        self.supply_system = supply_system
+        self.motion_planner = motion_planner
+        self.batch_planner = BatchPlanner(motion_planner)
+        self.tracker = tracker if tracker is not None else PredictionTracker()
+        self.placement_verifier = PlacementVerifier()
+        self.belt = belt
+        self.batch_filling = batch_filling
+        self.continuous_belt = continuous_belt
+        self.filled_track_ids = set()
+        self.unverified_holes = {}
+        self.placement_retries = {}
+        if belt is not None:
+            belt.add_state_callback(
+                lambda is_moving: self.emit("belt", moving=is_moving))
+
+        self.state = RoutineState.IDLE
+        self.trips = []
+        self.trip_index = 0
+        self._trip_commands = []
+        self._target_tracks = []
+        self._egg_cycle_started_at = 0.0
+        self._frame_sequence = 0
+        self._frame_timestamp = 0.0
+        self._frame = None
+        self._predictions_sequence = 0
+        self._tracked_predictions = None
+        self._state_deadline = 0.0
+        self._event_callbacks = []
+        self._stop_event = threading.Event()
+        self.thread = None
+
+        self._handlers = {
+            RoutineState.INSPECT: self.inspect,
+            RoutineState.PLAN: self.plan,
+            RoutineState.PICK: self.pick,
+            RoutineState.PLACE: self.place,
+            RoutineState.VERIFY: self.verify,
+            RoutineState.FINISH: self.finish,
+            RoutineState.ADVANCE_BELT: self.advance_belt,
+        }
+
+    @property
+    def is_running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def add_event_callback(self, callback: Callable[[RoutineEvent], None]):
+        self._event_callbacks.append(callback)
+
+    def emit(self, name: str, **fields):
+        event = RoutineEvent(name, self.state, **fields)
+        for callback in self._event_callbacks:
+            callback(event)
+
+    def start(self):
+        if self.is_running:
+            return
+        self._stop_event.clear()
+        self.tracker.reset()
+        self._egg_cycle_started_at = time.monotonic()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout: float | None = 5.0):
+        self._stop_event.set()
+        # Unblocks any state waiting on the robot
+        self.motion_planner.scara_robot.command_queue.cancel()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout)
+
+    def _run(self):
+        self._set_state(RoutineState.INSPECT)
+        try:
+            while self.state not in (RoutineState.IDLE, RoutineState.ERROR):
+                self._state_deadline = time.monotonic() + \
+                    SupplyRoutine.STATE_TIMEOUT_SECONDS[self.state]
+                try:
+                    with instrumentation.span(f"routine.{self.state.value}"):
+                        next_state = self._handlers[self.state]()
+                except StateTimeout:
+                    self.emit("timeout")
+                    next_state = SupplyRoutine.TIMEOUT_STATES[self.state]
+                    if next_state is RoutineState.ERROR:
+                        self.emit("alarm", reason="timeout")
+                except (RobotError, CancelledError, ValueError) as e:
+                    self.emit("error", error=str(e))
+                    next_state = RoutineState.ERROR
+                if next_state is RoutineState.ERROR:
+                    self.motion_planner.scara_robot.command_queue.cancel()
+                self._set_state(next_state)
+        except RoutineStopped:
+            self._set_state(RoutineState.IDLE)
+        finally:
+            if self.belt is not None:
+                self.belt.stop()
+            self.emit("stopped")
+
+    def _set_state(self, state: RoutineState):
+        previous_state = self.state
+        self.state = state
+        self.emit("state_changed", previous=previous_state.value)
+
+    def observe(self):
+        # Feeds the pipeline and tracker from this thread so a stalled GUI can't starve them
+        sequence, timestamp, frame = self.frame_grabber.read_newer(
+            self._frame_sequence, timeout=SupplyRoutine.POLL_SECONDS)
+        if frame is not None:
+            self._frame_sequence = sequence
+            self._frame_timestamp = timestamp
+            self._frame = frame
+            # On a moving belt a replayed batch would freeze the positions
+            # under new timestamps and drag the fitted velocity to zero.
+            # Tentative tracks need real detections to be confirmed
+            self.prediction_pipeline.submit(
+                sequence, frame, timestamp,
+                use_cache=not self.continuous_belt and not self.tracker.tentative_tracks())
+        predictions_sequence, timestamp, predictions = self.prediction_pipeline.latest_timestamped()
+        if predictions_sequence != self._predictions_sequence:
+            self._predictions_sequence = predictions_sequence
+            # A cache hit hands back the very same batch, it isn't a new detection
+            if predictions is self._tracked_predictions:
+                self.tracker.hold()
+            else:
+                self._tracked_predictions = predictions
+                self.tracker.update(predictions, timestamp)
+
+    def wait_for(self, condition: Callable[[], bool]):
+        while not condition():
+            if self._stop_event.is_set():
+                raise RoutineStopped()
+            if time.monotonic() > self._state_deadline:
+                raise StateTimeout()
+            self.observe()
+
+    def reset_inspection(self):
+        # The carton changed, every hole has to be confirmed again
+        self.tracker.reset()
+        self.filled_track_ids.clear()
+        self.unverified_holes.clear()
+        self.placement_retries.clear()
+        prediction_cache = self.prediction_pipeline.egg_predicter.prediction_cache
+        if prediction_cache is not None:
+            prediction_cache.invalidate()
+
+    def target_holes(self) -> list[Track]:
+        # Filled holes keep their track until the detector sees an egg there,
+        # unverified ones come back only once detected empty after the release
+        return [track for track in self.tracker.confirmed_tracks("hole")
+                if track.track_id not in self.filled_track_ids
+                and (track.track_id not in self.unverified_holes
+                     or (track.updated_at or 0.0) > self.unverified_holes[track.track_id])]
+
+    def learn_appearance(self):
+        # Confirmed tracks keep the verifier's egg and hole references up to date
+        if self._frame is not None:
+            self.placement_verifier.learn(
+                self._frame, self.tracker.confirmed_tracks(), self._frame_timestamp,
+                self.prediction_pipeline.egg_predicter.lens)
+
+    def detect_supply(self) -> int:
+        return self.supply_system.detect(
+            self.prediction_pipeline.egg_predicter.supply_predictions, self.reference_system)
+
+    def wait_for_supply(self):
+        # Not a timeout: the routine holds until a tray is refilled or detected full
+        self.emit("supply_empty")
+        if self.belt is not None and self.continuous_belt:
+            self.belt.stop()
+        last_detection = time.monotonic()
+        while not self.supply_system.remaining_supply_eggs():
+            if self._stop_event.is_set():
+                raise RoutineStopped()
+            self.observe()
+            if time.monotonic() - last_detection > SupplyRoutine.SUPPLY_POLL_SECONDS:
+                last_detection = time.monotonic()
+                self.detect_supply()
+        self.emit("supply_refilled",
+                  remaining=len(self.supply_system.remaining_supply_eggs()))
+        self._state_deadline = time.monotonic() + \
+            SupplyRoutine.STATE_TIMEOUT_SECONDS[self.state]
+
+    def inspect(self) -> RoutineState:
+        if self.supply_system.supply_roi is not None:
+            self.detect_supply()
+        if not self.supply_system.remaining_supply_eggs():
+            self.wait_for_supply()
+        if self.continuous_belt:
+            if self.belt is not None:
+                self.belt.move()
+            # The belt never stops, wait for a hole and a velocity estimate
+            try:
+                self.wait_for(lambda: len(self.target_holes()) > 0
+                              and self.tracker.velocity() is not None)
+            except StateTimeout:
+                # No carton under the camera yet, not a fault
+                return RoutineState.INSPECT
+            velocity = self.tracker.velocity()
+            self.learn_appearance()
+            self.emit("inspected", holes=len(self.target_holes()),
+                      velocity=(round(float(velocity[0]), 1), round(float(velocity[1]), 1)))
+            return RoutineState.PLAN
+        self.wait_for(lambda: self.tracker.is_stable)
+        self.learn_appearance()
+        holes = self.target_holes()
+        self.emit("inspected", holes=len(holes),
+                  eggs=len(self.tracker.confirmed_tracks("egg")))
+        if holes:
+            return RoutineState.PLAN
+        if self.tracker.tentative_tracks("hole"):
+            # Never move a carton on while a hole is still being confirmed
+            return RoutineState.INSPECT
+        return RoutineState.ADVANCE_BELT
+
+    def plan_moving_target(self, hole: Track, supply_egg: SupplyEgg,
+                           start_joints: list[float] | None) -> BatchTrip | None:
+        # Aim where the hole will be when the gripper opens, not where it was seen
+        velocity = self.tracker.velocity()
+        observation_age = time.monotonic() - hole.updated_at
+        lead_time = 0.0
+        trip = None
+        for _ in range(SupplyRoutine.PREDICTION_ITERATIONS):
+            position_camera = hole.position + \
+                velocity * (observation_age + lead_time)
+            target_point_robot = self.reference_system.get_robot_coordinates(
+                *position_camera)
+            trip = BatchTrip(supply_egg, 0, target_point_robot)
+            try:
+                trip.motion_plan = self.motion_planner.plan_pick_and_place(
+                    supply_egg, target_point_robot[0], target_point_robot[1],
+                    start_joints=start_joints)
+            except ValueError:
+                # The hole will have left the workspace by then
+                return None
+            lead_time = trip.motion_plan.time_until("G21")
+        return trip
+
+    def plan(self) -> RoutineState:
+        holes = self.target_holes()
+        remaining_supply_eggs = self.supply_system.remaining_supply_eggs()
+        if not holes:
+            return RoutineState.INSPECT
+        start_joints = self.motion_planner.current_joints()
+
+        if self.continuous_belt:
+            self.trips = []
+            for hole in holes:
+                hole_point_robot = self.reference_system.get_robot_coordinates(
+                    hole.cx, hole.cy)
+                supply_egg = self.supply_system.nearest_supply_egg(
+                    hole_point_robot[0], hole_point_robot[1])
+                # One trip per program, it returns home to clear the camera's view
+                trip = self.plan_moving_target(hole, supply_egg, start_joints)
+                if trip is not None:
+                    self.trips = [trip]
+                    self._target_tracks = [hole]
+                    break
+            if not self.trips:
+                self.emit("unreachable", holes=len(holes))
+                return RoutineState.INSPECT
+            self.emit("planned", trips=1, track=hole.track_id,
+                      lead_time=round(self.trips[0].motion_plan.time_until("G21"), 2),
+                      estimated_time=round(self.trips[0].motion_plan.estimated_time_seconds, 2))
+        elif self.batch_filling:
+            targets_point_robot = self.reference_system.get_robot_coordinates_batch(
+                [(hole.cx, hole.cy) for hole in holes])
+            batch_plan = self.batch_planner.plan(
+                targets_point_robot, remaining_supply_eggs, start_joints=start_joints)
+            self.trips = batch_plan.trips
+            self._target_tracks = [holes[trip.target_index]
+                                   for trip in self.trips]
+            self.emit("planned", trips=len(self.trips),
+                      estimated_time=round(batch_plan.motion_plan.estimated_time_seconds, 2),
+                      sequential_eggs_per_minute=round(batch_plan.sequential_eggs_per_minute, 2),
+                      batch_eggs_per_minute=round(batch_plan.eggs_per_minute, 2))
+        else:
+            target_point_robot = self.reference_system.get_robot_coordinates(
+                holes[0].cx, holes[0].cy)
+            trip = BatchTrip(self.supply_system.nearest_supply_egg(
+                target_point_robot[0], target_point_robot[1]), 0, target_point_robot)
+            # The next hole waits for another inspection, the arm can't stay over the carton
+            trip.motion_plan = self.motion_planner.plan_pick_and_place(
+                trip.supply_egg, target_point_robot[0], target_point_robot[1],
+                start_joints=start_joints)
+            self.trips = [trip]
+            self._target_tracks = [holes[0]]
+            self.emit("planned", trips=1,
+                      estimated_time=round(trip.motion_plan.estimated_time_seconds, 2))
+
+        # The whole program is streamed at once, the states only follow its progress
+        commands = [command for trip in self.trips
+                    for command in trip.motion_plan.commands]
+        self.emit("program", commands=commands)
+        robot_program = self.motion_planner.scara_robot.command_queue.submit_program(
+            commands)
+        self._trip_commands = []
+        for trip in self.trips:
+            self._trip_commands.append(
+                robot_program[:len(trip.motion_plan.commands)])
+            robot_program = robot_program[len(trip.motion_plan.commands):]
+        self.trip_index = 0
+        return RoutineState.PICK
+
+    def wait_robot_command(self, robot_command: RobotCommand):
+        self.wait_for(robot_command.completed.done)
+        if self._stop_event.is_set():
+            # Cancelled by stop(), not a robot failure
+            raise RoutineStopped()
+        robot_command.completed.result()
+
+    def pick(self) -> RoutineState:
+        trip_commands = self._trip_commands[self.trip_index]
+        grab_command = next(robot_command for robot_command in trip_commands
+                            if robot_command.command.startswith("G20"))
+        self.wait_robot_command(grab_command)
+        # Gone from the tray once grabbed, whatever happens to the rest of the trip
+        self.supply_system.mark_used(self.trips[self.trip_index].supply_egg)
+        self.emit("picked", supply_egg=self.trips[self.trip_index].supply_egg.key)
+        return RoutineState.PLACE
+
+    def place(self) -> RoutineState:
+        # Placed once the arm rises after opening the gripper, the rest is travel
+        trip_commands = self._trip_commands[self.trip_index]
+        release_index = next(i for i, robot_command in enumerate(trip_commands)
+                             if robot_command.command.startswith("G21"))
+        raise_command = trip_commands[min(release_index + 1, len(trip_commands) - 1)]
+        self.wait_robot_command(raise_command)
+        target = self.trips[self.trip_index].target
+        self.emit("placed", target=(round(float(target[0]), 2),
+                                    round(float(target[1]), 2)))
+        return RoutineState.VERIFY
+
+    def departure_command(self) -> RobotCommand | None:
+        # First move after the release that takes the arm off the hole:
+        # the transit to the next pick or the return home
+        program = [robot_command for trip_commands in self._trip_commands[self.trip_index:]
+                   for robot_command in trip_commands]
+        release_index = next(i for i, robot_command in enumerate(program)
+                             if robot_command.command.startswith("G21"))
+        return next((robot_command for robot_command in program[release_index + 1:]
+                     if robot_command.command.startswith(("G0 ", "G11 H"))), None)
+
+    def verify(self) -> RoutineState:
+        # Checks only the target hole's box on the first frame after the arm left
+        hole = self._target_tracks[self.trip_index]
+        departure_command = self.departure_command()
+        start_time = time.monotonic()
+        score = None
+        if departure_command is not None:
+            self.wait_robot_command(departure_command)
+            self.wait_for(lambda: self._frame_timestamp >
+                          departure_command.completed_at + SupplyRoutine.VERIFY_SETTLE_SECONDS)
+            start_time = time.monotonic()
+            cx, cy = hole.predicted_position(self._frame_timestamp)
+            score = self.placement_verifier.filled_score(
+                self._frame, cx, cy, hole.width, hole.height,
+                self.prediction_pipeline.egg_predicter.lens)
+        # Otherwise the program ends over the hole, it stays unverified
+        self.emit("verified", track=hole.track_id,
+                  score=None if score is None else round(score, 2),
+                  duration=round(time.monotonic() - start_time, 4))
+
+        if score is not None and score < SupplyRoutine.MIN_FILLED_SCORE:
+            retries = self.placement_retries.get(hole.track_id, 0) + 1
+            self.placement_retries[hole.track_id] = retries
+            if retries > SupplyRoutine.MAX_PLACEMENT_RETRIES:
+                self.emit("alarm", reason="placement_failed", track=hole.track_id)
+                return RoutineState.ERROR
+            # Left out of filled_track_ids, the next plan targets it again
+            self.emit("placement_failed", track=hole.track_id, retry=retries)
+        else:
+            if score is None:
+                # Can't tell yet, the hole is only targeted again if it's still seen empty
+                self.unverified_holes[hole.track_id] = self._frame_timestamp
+            else:
+                self.filled_track_ids.add(hole.track_id)
+            # Seconds per egg, inspections and retries included
+            now = time.monotonic()
+            instrumentation.record("egg_cycle", now - self._egg_cycle_started_at)
+            self._egg_cycle_started_at = now
+
+        self.trip_index += 1
+        if self.trip_index < len(self.trips):
+            return RoutineState.PICK
+        return RoutineState.FINISH
+
+    def finish(self) -> RoutineState:
+        # The next plan starts from where the program leaves the arm
+        self.wait_robot_command(self._trip_commands[-1][-1])
+        self.emit("egg_supplied", eggs=len(self.trips))
+        if self.unverified_holes and not self.continuous_belt:
+            # Nothing to verify against yet, confirm with a full inspection
+            self.reset_inspection()
+        return RoutineState.INSPECT
+
+    def advance_belt(self) -> RoutineState:
+        # Runs the belt until the next carton shows a hole under the camera
+        if self.belt is not None:
+            self.belt.move()
+        self.reset_inspection()
+        try:
+            self.wait_for(lambda: len(self.target_holes()) > 0)
+        finally:
+            if self.belt is not None and not self.continuous_belt:
+                self.belt.stop()
+        if not self.continuous_belt:
+            self.reset_inspection()
+        return RoutineState.INSPECT
+
+
+if __name__ == "__main__":
+    from predicter import EggPredicter
+    from scara_robot import ScaraRobot
+
+    frame_grabber = FrameGrabber(2)
+    prediction_pipeline = PredictionPipeline(
+        EggPredicter(0.5, frame_grabber))
+    scara_robot = ScaraRobot("/dev/ttyUSB0", 115200)
+    supply_routine = SupplyRoutine(frame_grabber, prediction_pipeline,
+                                   ReferenceSystem(frame_grabber), SupplySystem(),
+                                   MotionPlanner(scara_robot))
+    supply_routine.add_event_callback(print)
+    supply_routine.start()
+    try:
+        supply_routine.thread.join()
+    except KeyboardInterrupt:
+        supply_routine.stop()
+    scara_robot.close()
+    frame_grabber.release()
+    prediction_pipeline.shutdown()
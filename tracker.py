@@ -0,0 +1,185 @@
+import numpy as np
+from collections import deque
+from scipy.optimize import linear_sum_assignment
+from typing import Literal
+from prediction import Prediction, PredictionBatch
+
+
+class Track:
+    track_id: int
+    class_label: Literal["egg", "hole"]
+    position: np.ndarray
+    velocity: np.ndarray
+    updated_at: float | None
+    history: deque[tuple[float, float, float]]
+    width: float
+    height: float
+    confidence: float
+    confirmations: int
+    missed_updates: int
+
+    HISTORY_SIZE: int = 30
+
+    def __init__(self, track_id: int, prediction: Prediction, timestamp: float | None = None):
+        self.track_id = track_id
+        self.class_label = prediction.class_label
+        self.position = np.array(
+            (prediction.cx, prediction.cy), dtype=np.float64)
+        # Pixels per second, only estimated when updates carry timestamps
+        self.velocity = np.zeros(2)
+        self.updated_at = timestamp
+        self.history = deque(maxlen=Track.HISTORY_SIZE)
+        if timestamp is not None:
+            self.history.append((timestamp, prediction.cx, prediction.cy))
+        self.width = prediction.width
+        self.height = prediction.height
+        self.confidence = prediction.confidence
+        self.confirmations = 1
+        self.missed_updates = 0
+
+    @property
+    def cx(self) -> int:
+        return int(round(self.position[0]))
+
+    @property
+    def cy(self) -> int:
+        return int(round(self.position[1]))
+
+    def predicted_position(self, timestamp: float | None) -> np.ndarray:
+        if timestamp is None or self.updated_at is None:
+            return self.position
+        return self.position + self.velocity * (timestamp - self.updated_at)
+
+    def update(self, prediction: Prediction, smoothing: float, timestamp: float | None = None):
+        # Without timestamps the velocity stays at zero and this only smooths the position
+        measured = np.array((prediction.cx, prediction.cy), dtype=np.float64)
+        predicted = self.predicted_position(timestamp)
+        self.position = predicted + smoothing * (measured - predicted)
+        if timestamp is not None:
+            self.history.append((timestamp, prediction.cx, prediction.cy))
+            self.updated_at = timestamp
+            if len(self.history) >= 3:
+                # Least squares slope over the recent detections, robust to jitter
+                history = np.array(self.history)
+                self.velocity = np.polyfit(
+                    history[:, 0] - timestamp, history[:, 1:], 1)[0]
+        self.width += smoothing * (prediction.width - self.width)
+        self.height += smoothing * (prediction.height - self.height)
+        self.confidence = prediction.confidence
+        self.confirmations += 1
+        self.missed_updates = 0
+
+    def as_prediction(self) -> Prediction:
+        return Prediction(self.cx, self.cy, int(self.width), int(self.height),
+                          self.confidence, "eggs" if self.class_label == "egg" else "hole")
+
+
+class PredictionTracker:
+    MAX_DISTANCE_PX: float = 30
+    MAX_MISSED_UPDATES: int = 3
+    MIN_CONFIRMATIONS: int = 3
+    SMOOTHING: float = 0.5
+    # Detections before a track's velocity is trusted
+    VELOCITY_UPDATES: int = 10
+    # Updates without tracks being created or lost to consider the scene stable
+    STABLE_UPDATES: int = 5
+
+    tracks: list[Track]
+    stable_updates: int
+
+    def __init__(self, max_distance_px: float = MAX_DISTANCE_PX,
+                 max_missed_updates: int = MAX_MISSED_UPDATES,
+                 min_confirmations: int = MIN_CONFIRMATIONS,
+                 smoothing: float = SMOOTHING):
+        self.max_distance_px = max_distance_px
+        self.max_missed_updates = max_missed_updates
+        self.min_confirmations = min_confirmations
+        self.smoothing = smoothing
+        self.tracks = []
+        self.stable_updates = 0
+        self._next_track_id = 0
+
+    def update(self, predictions: PredictionBatch, timestamp: float | None = None) -> list[Track]:
+        matched_tracks = set()
+        matched_predictions = set()
+
+        if self.tracks and len(predictions):
+            # Match against where moving tracks should be by now
+            track_positions = np.array([t.predicted_position(timestamp)
+                                        for t in self.tracks])
+            prediction_positions = predictions.centroids().astype(np.float64)
+            cost = np.linalg.norm(
+                track_positions[:, None, :] - prediction_positions[None, :, :], axis=2)
+
+            track_labels = np.array([t.class_label for t in self.tracks])
+            prediction_labels = predictions.class_labels()
+            invalid = (track_labels[:, None] != prediction_labels[None, :]) | \
+                (cost > self.max_distance_px)
+            cost[invalid] = 1e6
+
+            for row, column in zip(*linear_sum_assignment(cost)):
+                if invalid[row, column]:
+                    continue
+                self.tracks[row].update(
+                    predictions[column], self.smoothing, timestamp)
+                matched_tracks.add(row)
+                matched_predictions.add(column)
+
+        is_changed = False
+        for i, track in enumerate(self.tracks):
+            if i not in matched_tracks:
+                track.missed_updates += 1
+        remaining_tracks = [t for t in self.tracks
+                            if t.missed_updates <= self.max_missed_updates]
+        if len(remaining_tracks) != len(self.tracks):
+            is_changed = True
+        self.tracks = remaining_tracks
+
+        # New objects start with the belt velocity instead of standing still
+        velocity = self.velocity() if timestamp is not None else None
+        for i in range(len(predictions)):
+            if i not in matched_predictions:
+                track = Track(self._next_track_id, predictions[i], timestamp)
+                if velocity is not None:
+                    track.velocity = velocity.copy()
+                self.tracks.append(track)
+                self._next_track_id += 1
+                is_changed = True
+
+        self.stable_updates = 0 if is_changed else self.stable_updates + 1
+        return self.tracks
+
+    def hold(self):
+        # Replayed detections (prediction cache hit): the scene didn't change,
+        # but nothing was measured again, so no track is confirmed or aged.
+        # Only counts towards stability once every track is confirmed
+        if not self.tentative_tracks():
+            self.stable_updates += 1
+
+    def confirmed_tracks(self, class_label: str | None = None) -> list[Track]:
+        return [t for t in self.tracks
+                if t.confirmations >= self.min_confirmations
+                and (class_label is None or t.class_label == class_label)]
+
+    def tentative_tracks(self, class_label: str | None = None) -> list[Track]:
+        return [t for t in self.tracks
+                if t.confirmations < self.min_confirmations
+                and (class_label is None or t.class_label == class_label)]
+
+    def velocity(self) -> np.ndarray | None:
+        # Every object rides the same belt, the median rejects bad associations
+        velocities = [t.velocity for t in self.tracks
+                      if len(t.history) >= PredictionTracker.VELOCITY_UPDATES]
+        if not velocities:
+            return None
+        return np.median(velocities, axis=0)
+
+    @property
+    def is_stable(self) -> bool:
+        # A track still waiting for confirmations could be a hole to fill
+        return self.stable_updates >= PredictionTracker.STABLE_UPDATES \
+            and not self.tentative_tracks()
+
+    def reset(self):
+        self.tracks = []
+        self.stable_updates = 0